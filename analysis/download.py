@@ -0,0 +1,97 @@
+#! /usr/bin/env python3
+
+# Author: Paolo Bonzini
+# Licensed under AGPLv3.
+
+# Download daily logs from the vendor datalogger into a directory of
+# YYYYMMDDVL.csv files, the same layout that ensolar2.py writes and
+# pvanalysis.py reads.
+#
+# Days are fetched concurrently.  Days that are already in the directory
+# are never fetched again, even if they were compressed by ensolar2log.py
+# --compact; each file is written under a temporary name
+# and renamed once complete, so an interrupted download can simply be
+# started again.  Only days before today are downloaded, because the
+# current day is not complete yet.
+
+import argparse
+import base64
+import concurrent.futures
+import datetime
+import os
+import sys
+import urllib.request
+
+DEFAULT_URL = 'http://192.168.10.236/api/data/daily?d={}'
+
+
+def day_path(directory, day):
+    return os.path.join(directory, day.strftime('%Y%m%dVL.csv'))
+
+
+def fetch(url, day, directory, headers={}, timeout=60):
+    path = day_path(directory, day)
+    request = urllib.request.Request(url.format(day.strftime('%Y%m%d')), headers=headers)
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        data = response.read()
+    # an error page or an empty body would be taken for the day's log
+    header = data.split(b'\n', 1)[0].decode(errors='replace').strip().split(',')
+    if 'TS' not in header:
+        raise ValueError('response is not a CSV log')
+    with open(path + '.tmp', 'wb') as f:
+        f.write(data)
+    os.replace(path + '.tmp', path)
+    return len(data)
+
+
+def missing_days(directory, start, end):
+    day = start
+    while day <= end:
+        path = day_path(directory, day)
+        if not os.path.exists(path) and not os.path.exists(path + '.gz'):
+            yield day
+        day += datetime.timedelta(days=1)
+
+
+def download(url, directory, start, end, jobs=8, headers={}, timeout=60):
+    end = min(end, datetime.date.today() - datetime.timedelta(days=1))
+    errors = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(fetch, url, day, directory, headers, timeout): day
+                   for day in missing_days(directory, start, end)}
+        for f in concurrent.futures.as_completed(futures):
+            day = futures[f]
+            try:
+                print(day, f.result(), file=sys.stderr)
+            except Exception as e:
+                print(day, e, file=sys.stderr)
+                errors += 1
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Download daily logs from the Ensolar2 datalogger.')
+    parser.add_argument('--url', default=DEFAULT_URL,
+                        help='URL of the daily data, with {} in place of the date')
+    parser.add_argument('--user', metavar='USER:PASSWORD', help='HTTP basic authentication')
+    parser.add_argument('--directory', metavar='DIR', default='.', help='where to store the logs')
+    parser.add_argument('--jobs', metavar='N', type=int, default=8, help='concurrent downloads')
+    parser.add_argument('--timeout', metavar='SECONDS', type=float, default=60,
+                        help='timeout for each download')
+    parser.add_argument('start', type=datetime.date.fromisoformat, help='first day (YYYY-MM-DD)')
+    parser.add_argument('end', type=datetime.date.fromisoformat, nargs='?',
+                        default=datetime.date.today(), help='last day (YYYY-MM-DD)')
+    args = parser.parse_args()
+
+    headers = {}
+    if args.user:
+        headers['Authorization'] = 'Basic ' + base64.b64encode(args.user.encode()).decode()
+
+    os.makedirs(args.directory, exist_ok=True)
+    errors = download(args.url, args.directory, args.start, args.end,
+                      jobs=args.jobs, headers=headers, timeout=args.timeout)
+    sys.exit(1 if errors else 0)
+
+
+if __name__ == '__main__':
+    main()
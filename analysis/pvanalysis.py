@@ -0,0 +1,216 @@
+#! /usr/bin/env python3
+
+# Author: Paolo Bonzini
+# Licensed under AGPLv3.
+
+# Energy balance rollups from ensolar2 (or vendor datalogger) logs.
+#
+# Computes the same tables as the awk passes that used to be in pv.sh,
+# in a single pass over the data:
+#
+# - clean: one row per sample, with the power flows split into buy/sell,
+#   charge/discharge, home consumption and inverter overhead
+# - hourly: energy (kWh) per hour.  Until the first PV production of the
+#   day, samples are accounted to the previous day, so that the night
+#   belongs to the day before
+# - daily: energy per day
+# - hourwd: energy per weekday and hour, summed over all weeks
+#
+# Columns are looked up by name in the CSV header, so the input can be
+# any mix of CSV files (compressed or not) and binary logs (*.bin) written
+# by ensolar2.py.  In a directory, each day is read from its binary log
+# if there is one, and from the CSV log otherwise.  With --start and --end, only the days in the range are
+# read, and only the hours in the range are decompressed.
+
+import argparse
+import itertools
+import numpy
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import ensolar2log
+
+INPUT_FIELDS = ['TS', 'INVW', 'XGR', 'XPV', 'XBT', 'XHOME', 'XAUTO']
+ENERGY_FIELDS = ['BUY', 'SELL', 'PV', 'CHG', 'DIS', 'HOME', 'OVERHEAD']
+CHUNK_ROWS = 65536
+
+
+def read_csv(path, fields=INPUT_FIELDS, chunk_rows=CHUNK_ROWS, start=None, end=None):
+    f = ensolar2log.csv_lines(path, start, end)
+    header = next(f).rstrip('\n').split(',')
+    usecols = [header.index(name) for name in fields]
+    chunks = []
+    while True:
+        lines = list(itertools.islice(f, chunk_rows))
+        if not lines:
+            break
+        chunks.append(numpy.loadtxt(lines, delimiter=',', usecols=usecols, ndmin=2))
+    if not chunks:
+        return {name: numpy.empty(0) for name in fields}
+    data = numpy.concatenate(chunks)
+    return {name: data[:, i] for i, name in enumerate(fields)}
+
+
+def load(paths, fields=INPUT_FIELDS, start=None, end=None):
+    # Directories are expanded to the daily logs they contain
+    first, last = ensolar2log.day_range(start, end)
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += ensolar2log.daily_log_files(path, first, last)
+        else:
+            files.append(path)
+
+    parts = []
+    for path in files:
+        if path.endswith('.bin'):
+            columns = ensolar2log.read_binary(path)
+            ts = columns['TS'] / 1000
+            keep = numpy.ones(len(ts), dtype=bool)
+            if start is not None:
+                keep &= ts >= start
+            if end is not None:
+                keep &= ts < end
+            parts.append({name: numpy.asarray(columns[name], dtype=float)[keep] for name in fields})
+        else:
+            parts.append(read_csv(path, fields, start=start, end=end))
+    return {name: numpy.concatenate([p[name] for p in parts]) if parts else numpy.empty(0)
+            for name in fields}
+
+
+def clean(columns, tz_offset=2):
+    ts_ms = columns['TS'] + tz_offset * 3600000
+    h = (ts_ms // 3600000) % 24
+    m = (ts_ms // 60000) % 60
+    day = ts_ms // 86400000
+    wd = (day - 4) % 7
+    ts = day * 86400
+
+    invw = columns['INVW']
+    net = columns['XGR']
+    pv = columns['XPV']
+    bt = columns['XBT']
+    load = columns['XHOME']
+    auto = columns['XAUTO']
+
+    # Samples are accounted to the previous day until the first PV
+    # production after midnight; the counter restarts at every row of
+    # hour 0.
+    new_segment = h == 0
+    if len(h):
+        new_segment[0] = True
+    production = numpy.cumsum(pv > 0)
+    starts = numpy.flatnonzero(new_segment)
+    base = (production - (pv > 0))[starts][numpy.cumsum(new_segment) - 1]
+    delta = numpy.where(production > base, 0, -86400)
+
+    buy = numpy.where(net > 0, net, 0)
+    sell = numpy.where(net > 0, 0, -net)
+    chg = numpy.where(bt > 0, bt, 0)
+    dis = numpy.where(bt > 0, 0, -bt)
+    overhead = numpy.where(invw <= 0, -invw,
+                           numpy.where(dis != 0, load - auto, (buy + pv) - (sell + load + chg)))
+    w_in = buy + numpy.where(dis != 0, dis, pv)
+    w_out = sell + chg + overhead
+    home = w_in - w_out
+
+    return {'TS': ts, 'H': h, 'M': m, 'WD': wd, 'DELTA': delta,
+            'BUY': buy, 'SELL': sell, 'PV': pv, 'CHG': chg, 'DIS': dis,
+            'HOME': home, 'OVERHEAD': overhead}
+
+
+def _group_starts(*keys):
+    # Start of each run of consecutive rows with the same keys
+    change = numpy.zeros(len(keys[0]), dtype=bool)
+    if len(change):
+        change[0] = True
+    for key in keys:
+        change[1:] |= key[1:] != key[:-1]
+    return numpy.flatnonzero(change)
+
+
+def hourly(clean):
+    day = clean['TS'] + clean['DELTA']
+    starts = _group_starts(day, clean['H'])
+    if not len(starts):
+        return {name: numpy.empty(0) for name in ['TS', 'H', 'WD'] + ENERGY_FIELDS}
+
+    # Hours before the first one that is accounted to its own day are
+    # dropped, because the previous day is not complete; the last hour is
+    # always included.
+    keep = numpy.zeros(len(starts), dtype=bool)
+    first = numpy.flatnonzero(clean['DELTA'][starts] == 0)
+    if len(first):
+        keep[first[0]:] = True
+    keep[-1] = True
+
+    result = {'TS': day[starts], 'H': clean['H'][starts], 'WD': clean['WD'][starts]}
+    for name in ENERGY_FIELDS:
+        result[name] = numpy.add.reduceat(clean[name] / 1000 / 12, starts)
+    return {name: values[keep] for name, values in result.items()}
+
+
+def daily(hourly):
+    starts = _group_starts(hourly['TS'])
+    result = {'TS': hourly['TS'][starts], 'WD': hourly['WD'][starts]}
+    for name in ENERGY_FIELDS:
+        result[name] = numpy.add.reduceat(hourly[name], starts) if len(starts) else numpy.empty(0)
+    return result
+
+
+def hour_weekday(hourly):
+    wd, h = numpy.meshgrid(numpy.arange(7), numpy.arange(24), indexing='ij')
+    index = (hourly['WD'] * 24 + hourly['H']).astype(int)
+    count = numpy.bincount(index, minlength=7 * 24)
+    result = {'WD': wd.ravel(), 'H': h.ravel()}
+    for name in ['BUY', 'SELL', 'DIS', 'HOME']:
+        values = numpy.bincount(index, weights=hourly[name], minlength=7 * 24)
+        result[name] = numpy.where(count > 0, values, numpy.nan)
+    return result
+
+
+def _format(value):
+    # Same output as awk: integers as such, other numbers with %.6g, and
+    # an empty string for missing values
+    if value != value:
+        return ''
+    if value == int(value) and abs(value) < 1e16:
+        return str(int(value))
+    return '%.6g' % value
+
+
+def write_table(path, table, fields):
+    with open(path, 'w') as f:
+        print(*fields, sep='\t', file=f)
+        columns = [table[name].tolist() for name in fields]
+        for row in zip(*columns):
+            print(*map(_format, row), sep='\t', file=f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Energy balance rollups from ensolar2 logs.')
+    parser.add_argument('--tz-offset', metavar='HOURS', type=float, default=2,
+                        help='offset of local time from UTC')
+    parser.add_argument('--prefix', metavar='PREFIX', default='pv',
+                        help='prefix for the output files')
+    parser.add_argument('--start', metavar='YYYY-MM-DD[THH:MM]', type=ensolar2log.timestamp,
+                        help='only use samples from this time')
+    parser.add_argument('--end', metavar='YYYY-MM-DD[THH:MM]', type=ensolar2log.timestamp,
+                        help='only use samples before this time')
+    parser.add_argument('inputs', metavar='FILE', nargs='+',
+                        help='CSV or binary logs, or directories containing them')
+    args = parser.parse_args()
+
+    samples = clean(load(args.inputs, start=args.start, end=args.end), args.tz_offset)
+    hours = hourly(samples)
+    write_table(args.prefix + 'clean.csv', samples,
+                ['TS', 'H', 'M', 'WD', 'DELTA'] + ENERGY_FIELDS)
+    write_table(args.prefix + 'hourly.csv', hours, ['TS', 'H', 'WD'] + ENERGY_FIELDS)
+    write_table(args.prefix + 'daily.csv', daily(hours), ['TS', 'WD'] + ENERGY_FIELDS)
+    write_table(args.prefix + 'hourwd.csv', hour_weekday(hours),
+                ['WD', 'H', 'BUY', 'SELL', 'DIS', 'HOME'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+#! /usr/bin/env python3
+
+# Author: Paolo Bonzini
+# Licensed under AGPLv3.
+
+# Offline benchmarks for ensolar2.py, against the simulator in
+# ensolar2sim.py (started on a local TCP port unless --inverter is given):
+#
+# - poll: time to read the whole register map, compared with the estimate
+#   of the read planner, and the bus utilization of the scheduler
+# - decode: CPU time to decode the responses and compute the calculated
+#   and derived fields for one sample
+# - csv/binary: rows per second formatted and written by the log writers
+# - mqtt: samples per second published by MqttClient (needs --mqtt)
+# - stale: time from the simulator going silent until the scheduler drops
+#   the last fast tier values, against the limit of STALE_PERIODS fast
+#   periods (not run with --inverter)
+#
+# The simulator options (--baudrate, --crc-error-rate, --replay, ...) are
+# the same as for ensolar2sim.py.  With --json the results are printed as
+# a JSON object, for comparison across versions.
+
+from collections import defaultdict
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import ensolar2
+import ensolar2sim
+
+
+class Response:
+    # Stand-in for the pymodbus response objects
+    def __init__(self, registers=None, bits=None):
+        self.registers = registers
+        self.bits = bits
+
+
+def sample_responses(simulator, plan):
+    regs, bits = simulator.current()
+    responses = []
+    for block in plan.blocks:
+        end = block.start + block.count
+        if block.function == 'read_input_registers':
+            values = regs[block.start:end] + [0] * (end - len(regs))
+            responses.append(Response(registers=values[:block.count]))
+        else:
+            values = bits[block.start:end] + [False] * (end - len(bits))
+            # pymodbus pads the bits to a multiple of 8
+            responses.append(Response(bits=values[:block.count] + [False] * (-block.count % 8)))
+    return responses
+
+
+def timed(function, iterations):
+    start = time.perf_counter()
+    for i in range(iterations):
+        function()
+    return (time.perf_counter() - start) / iterations
+
+
+def bench_poll(conn, plan, cycles):
+    times = []
+    errors = 0
+    for i in range(cycles):
+        start = time.perf_counter()
+        for block in plan.blocks:
+            if not conn.read(block):
+                errors += 1
+        times.append(time.perf_counter() - start)
+    scheduler = ensolar2.Scheduler(conn)
+    return {
+        'cycle_mean': statistics.mean(times),
+        'cycle_max': max(times),
+        'cycle_estimate': plan.duration,
+        'failed_blocks': errors,
+        'modbus_errors': sum(c.value for c in ensolar2.MODBUS_ERRORS.children.values()),
+        'scheduler_utilization': scheduler.utilization,
+        'fast_period': scheduler.periods[ensolar2.FAST],
+    }
+
+
+def decode_sample(plan, responses):
+    snapshot = defaultdict(lambda: 0)
+    for block, rr in zip(plan.blocks, responses):
+        snapshot.update(block.decode(rr))
+    snapshot.update({ k: v(snapshot) for k, v in ensolar2.CALC_FIELDS.items() })
+    return snapshot, ensolar2.derived_fields(snapshot)
+
+
+def bench_decode(plan, responses, iterations):
+    return {'decode_us': timed(lambda: decode_sample(plan, responses), iterations) * 1e6}
+
+
+def bench_logs(snapshot, rows):
+    result = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for name, log in [('csv', ensolar2.CsvLogWriter(directory)),
+                          ('binary', ensolar2.binary_log_writer(directory))]:
+            regs = dict(snapshot)
+            def write():
+                # a new row every 5 minutes
+                regs['TS'] += 300000
+                log.write(regs)
+            result[name + '_rows_per_s'] = 1 / timed(write, rows)
+            log.close()
+        log = ensolar2.CsvLogWriter(directory)
+        result['csv_format_us'] = timed(lambda: log.format(snapshot), rows) * 1e6
+    return result
+
+
+def bench_mqtt(server, plan, simulator, samples):
+    mqtt = ensolar2.MqttClient(server, 'ensolar2bench', topic='ensolar2bench')
+    sent = 0
+    publish = mqtt.client.publish
+    def counting_publish(*args, **kwargs):
+        nonlocal sent
+        sent += 1
+        return publish(*args, **kwargs)
+    mqtt.client.publish = counting_publish
+
+    # replay the simulated rows, so that values change as in real use
+    rows = simulator.rows
+    start = time.perf_counter()
+    for i in range(samples):
+        simulator.rows = [rows[i % len(rows)]]
+        snapshot, fields = decode_sample(plan, sample_responses(simulator, plan))
+        mqtt.publish(fields)
+    elapsed = time.perf_counter() - start
+    simulator.rows = rows
+    mqtt.disconnect()
+    return {'mqtt_samples_per_s': samples / elapsed, 'mqtt_messages_per_sample': sent / samples}
+
+
+def bench_stale(device, simulator, timeout):
+    conn = ensolar2.ModbusConnection(device, request_delay=0, retries=0)
+    conn.client.timeout = 0.5
+    scheduler = ensolar2.Scheduler(conn, dict.fromkeys(ensolar2.TIER_PERIODS, 0.5), utilization=1)
+    snapshot = defaultdict(lambda: 0)
+    snapshot.update(scheduler.poll())
+    if 'PVW' not in snapshot:
+        raise RuntimeError('no values read from the simulator')
+
+    simulator.drop_rate = 1
+    start = time.monotonic()
+    try:
+        while 'PVW' in snapshot:
+            if time.monotonic() - start > timeout:
+                raise RuntimeError('stale values were not dropped')
+            time.sleep(max(0, scheduler.next_poll() - time.monotonic()))
+            snapshot.update(scheduler.poll())
+            scheduler.expire(snapshot)
+    finally:
+        simulator.drop_rate = 0
+        conn.close()
+    return {
+        'stale_drop_s': time.monotonic() - start,
+        'stale_limit_s': ensolar2.STALE_PERIODS * scheduler.periods[ensolar2.FAST],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark ensolar2.py against a simulated inverter.')
+    parser.add_argument('--inverter', metavar='DEVICE',
+                        help='serial port or HOST:PORT of an already running simulator')
+    parser.add_argument('--request-delay', metavar='SECONDS', type=float, default=0,
+                        help='minimum delay between Modbus requests')
+    parser.add_argument('--cycles', metavar='N', type=int, default=5, help='polls to time')
+    parser.add_argument('--iterations', metavar='N', type=int, default=10000,
+                        help='samples to decode, format and write')
+    parser.add_argument('--mqtt', metavar='ADDRESS', help='MQTT server for the publishing benchmark')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    ensolar2sim.add_arguments(parser)
+    args = parser.parse_args()
+
+    simulator = ensolar2sim.simulator_from_args(args)
+    device = args.inverter or f'127.0.0.1:{ensolar2sim.start_tcp(simulator)}'
+    conn = ensolar2.ModbusConnection(device, baudrate=args.baudrate,
+                                     request_delay=args.request_delay)
+    plan = conn.plan()
+
+    results = {}
+    results.update(bench_poll(conn, plan, args.cycles))
+    conn.close()
+    responses = sample_responses(simulator, plan)
+    results.update(bench_decode(plan, responses, args.iterations))
+    snapshot, fields = decode_sample(plan, responses)
+    results.update(bench_logs(snapshot, args.iterations))
+    if args.mqtt:
+        results.update(bench_mqtt(args.mqtt, plan, simulator, args.iterations))
+    if not args.inverter:
+        results.update(bench_stale(device, simulator, 60))
+
+    if args.json:
+        print(json.dumps(results))
+    else:
+        for k, v in results.items():
+            print(f'{k:24} {v:.6g}')
+
+
+if __name__ == '__main__':
+    main()
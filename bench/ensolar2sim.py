@@ -0,0 +1,254 @@
+#! /usr/bin/env python3
+
+# Author: Paolo Bonzini
+# Licensed under AGPLv3.
+
+# Ensolar2 inverter simulator, to run ensolar2.py without the inverter.
+#
+# The simulator answers Modbus RTU requests for the input registers and
+# discrete inputs in ensolar2.INPUT_REGS and ensolar2.DISCRETE_INP, either
+# on a pseudo-terminal or on a TCP port (the same framing as ser2net):
+#
+#   ./ensolar2sim.py --pty                   # prints the device to use
+#   ./ensolar2sim.py --tcp 5020              # ensolar2.py --inverter localhost:5020
+#
+# Answers are delayed by the time the request and response would take on a
+# serial line at the given baud rate, plus the inverter's turnaround time
+# and an optional extra latency.  Errors can be injected: corrupted CRCs,
+# requests that are not answered, and periodic outages.
+#
+# Values are either fixed and plausible, or replayed from CSV logs written
+# by ensolar2.py (compressed or not), moving to the next row every
+# --row-period seconds.
+
+import argparse
+import os
+import random
+import socket
+import sys
+import threading
+import time
+import tty
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import ensolar2
+import ensolar2log
+
+DEFAULT_VALUES = {
+    'TEMP': 35.0, 'VER': 1.05, 'BATS': 2, 'BATV': 52.3, 'BATA': 8.5,
+    'INPH': 50.0, 'INPV': 231.4, 'INPAP': 450, 'INPW': 420, 'INVH': 50.0,
+    'INVV': 230.1, 'INVA': 4.2, 'INVW': 950, 'PVV': 310.5, 'PVA': 5.1,
+    'PVW': 1580, 'BUSV': 380.2, 'SGCL': 12.34, 'STCL': 234.56, 'LOADV': 230.0,
+    'LOADA': 0.5, 'LOADW': 110, 'LOADAP': 120, 'LOADP': 2.0, 'SOC': 80,
+    'AMMV': 231.0, 'TEEH': 123.45, 'PEH': 67.89, 'NEH': 45.67,
+    'YADAI': 1.5, 'YADAP': 350.0, 'BT': 1, 'PV': 1,
+}
+
+REQUEST_LENGTH = 8
+
+
+def _crc_table():
+    table = []
+    for i in range(256):
+        crc = i
+        for bit in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+
+CRC_TABLE = _crc_table()
+
+
+def crc16(data):
+    crc = 0xFFFF
+    for b in data:
+        crc = (crc >> 8) ^ CRC_TABLE[(crc ^ b) & 0xFF]
+    return crc.to_bytes(2, 'little')
+
+
+def raw_values(values):
+    # Convert logged values back to register contents
+    regs = [0] * (max(v.index for v in ensolar2.INPUT_REGS.values()) + 1)
+    bits = [False] * (max(v.index for v in ensolar2.DISCRETE_INP.values()) + 1)
+    for name, conv in ensolar2.INPUT_REGS.items():
+        value = float(values.get(name, 0))
+        regs[conv.index] = round(value / (conv.factor or 1)) & 0xFFFF
+    for name, conv in ensolar2.DISCRETE_INP.items():
+        bits[conv.index] = bool(int(float(values.get(name, 0))))
+    return regs, bits
+
+
+def read_csv(paths):
+    rows = []
+    for path in paths:
+        lines = ensolar2log.csv_lines(path)
+        header = next(lines).rstrip('\n').split(',')
+        for line in lines:
+            rows.append(raw_values(dict(zip(header, line.rstrip('\n').split(',')))))
+    return rows
+
+
+class Simulator:
+    def __init__(self, rows=None, unit=1, baudrate=2400, latency=0, row_period=5,
+                 crc_error_rate=0, drop_rate=0, outage_every=0, outage_length=0):
+        self.rows = rows or [raw_values(DEFAULT_VALUES)]
+        self.unit = unit
+        self.char_time = ensolar2.RTU_CHAR_BITS / baudrate
+        self.latency = latency
+        self.row_period = row_period
+        self.crc_error_rate = crc_error_rate
+        self.drop_rate = drop_rate
+        self.outage_every = outage_every
+        self.outage_length = outage_length
+        self.start = time.monotonic()
+        self.requests = 0
+        self.errors = 0
+
+    def current(self):
+        now = time.monotonic() - self.start
+        return self.rows[int(now // self.row_period) % len(self.rows)]
+
+    def offline(self):
+        if not self.outage_every:
+            return False
+        return (time.monotonic() - self.start) % self.outage_every < self.outage_length
+
+    def answer(self, request):
+        unit, function = request[0], request[1]
+        address = int.from_bytes(request[2:4], 'big')
+        count = int.from_bytes(request[4:6], 'big')
+        regs, bits = self.current()
+        if function == 4 and 1 <= count <= ensolar2.MAX_READ_REGS:
+            values = [regs[i] if i < len(regs) else 0 for i in range(address, address + count)]
+            data = b''.join(v.to_bytes(2, 'big') for v in values)
+        elif function == 2 and 1 <= count <= ensolar2.MAX_READ_BITS:
+            value = sum(1 << (i - address) for i in range(address, address + count)
+                        if i < len(bits) and bits[i])
+            data = value.to_bytes((count + 7) // 8, 'little')
+        else:
+            # illegal function or data value
+            response = bytes([unit, function | 0x80, 1 if function not in (2, 4) else 3])
+            return response + crc16(response)
+
+        response = bytes([unit, function, len(data)]) + data
+        return response + crc16(response)
+
+    def respond(self, request):
+        # Returns the response to a request, or None
+        self.requests += 1
+        if request[0] != self.unit or self.offline() or random.random() < self.drop_rate:
+            return None
+        response = self.answer(request)
+        time.sleep((len(request) + len(response) + 2 * ensolar2.RTU_FRAME_GAP) * self.char_time +
+                   ensolar2.RTU_TURNAROUND + self.latency)
+        if random.random() < self.crc_error_rate:
+            self.errors += 1
+            response = response[:-1] + bytes([response[-1] ^ 0xFF])
+        return response
+
+    def serve(self, read, write):
+        # Requests for function codes 2 and 4 are always 8 bytes; after a
+        # bad CRC, resynchronize one byte at a time.
+        buf = b''
+        while True:
+            data = read()
+            if not data:
+                return
+            buf += data
+            while len(buf) >= REQUEST_LENGTH:
+                request = buf[:REQUEST_LENGTH]
+                if crc16(request[:-2]) != request[-2:]:
+                    buf = buf[1:]
+                    continue
+                buf = buf[REQUEST_LENGTH:]
+                response = self.respond(request)
+                if response:
+                    write(response)
+
+
+def serve_pty(simulator):
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    print(os.ttyname(slave), flush=True)
+    # keep the slave open, so that reads do not fail between connections
+    simulator.serve(lambda: os.read(master, 256), lambda data: os.write(master, data))
+
+
+def serve_tcp(simulator, port, host='127.0.0.1', ready=None):
+    server = socket.create_server((host, port))
+    if ready:
+        ready(server.getsockname()[1])
+
+    def client(conn):
+        with conn:
+            try:
+                simulator.serve(lambda: conn.recv(256), conn.sendall)
+            except ConnectionError:
+                pass
+
+    while True:
+        conn, addr = server.accept()
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        threading.Thread(target=client, args=(conn,), daemon=True).start()
+
+
+def start_tcp(simulator, host='127.0.0.1'):
+    # Run the simulator on a thread and return its port
+    ready = threading.Event()
+    result = []
+    def set_port(port):
+        result.append(port)
+        ready.set()
+    threading.Thread(target=serve_tcp, args=(simulator, 0, host, set_port), daemon=True).start()
+    ready.wait()
+    return result[0]
+
+
+def add_arguments(parser):
+    parser.add_argument('--baudrate', metavar='BPS', type=int, default=2400,
+                        help='simulated line speed')
+    parser.add_argument('--latency', metavar='SECONDS', type=float, default=0,
+                        help='extra delay before each response')
+    parser.add_argument('--crc-error-rate', metavar='FRACTION', type=float, default=0,
+                        help='fraction of responses with a corrupted CRC')
+    parser.add_argument('--drop-rate', metavar='FRACTION', type=float, default=0,
+                        help='fraction of requests that are not answered')
+    parser.add_argument('--outage', metavar='LENGTH,EVERY', default='0,0',
+                        help='stop answering for LENGTH seconds every EVERY seconds')
+    parser.add_argument('--replay', metavar='CSV', nargs='+', default=[],
+                        help='replay values from ensolar2.py CSV logs')
+    parser.add_argument('--row-period', metavar='SECONDS', type=float, default=5,
+                        help='how long each replayed row is served')
+
+
+def simulator_from_args(args, unit=1):
+    length, _, every = args.outage.partition(',')
+    return Simulator(read_csv(args.replay), unit=unit, baudrate=args.baudrate,
+                     latency=args.latency, row_period=args.row_period,
+                     crc_error_rate=args.crc_error_rate, drop_rate=args.drop_rate,
+                     outage_every=float(every or 0), outage_length=float(length))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulate an Ensolar2 inverter on Modbus RTU.')
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--pty', action='store_true', help='serve on a pseudo-terminal')
+    group.add_argument('--tcp', metavar='[HOST:]PORT', help='serve on a TCP port')
+    parser.add_argument('--unit', metavar='N', type=int, default=1, help='Modbus unit id')
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    simulator = simulator_from_args(args, args.unit)
+    try:
+        if args.pty:
+            serve_pty(simulator)
+        else:
+            host, _, port = args.tcp.rpartition(':')
+            serve_tcp(simulator, int(port), host or '127.0.0.1')
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
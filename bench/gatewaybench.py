@@ -0,0 +1,247 @@
+#! /usr/bin/env python3
+
+# Author: Paolo Bonzini
+# Licensed under AGPLv3.
+
+# Benchmarks for ha-mqtt-gateway.py, against the fake Home Assistant in
+# hassim.py and the MQTT broker in mqttstub.py.  Both run in this process,
+# while the gateway runs as a subprocess:
+#
+# - dump: time from authentication until the states of all entities have
+#   been published, and the gateway's resident memory before and after
+#   (the peak is VmHWM, i.e. during the get_states dump)
+# - steady: state_changed events per second through the gateway, and the
+#   percentiles of the latency from last_updated to the broker, with
+#   events fired at --rate
+# - burst: the same for --burst events fired as fast as possible, plus the
+#   time to drain them
+# - reconnect: time from closing the websocket until a state change made
+#   after that is published again
+# - remove: time from removing an entity, right after a change that adds
+#   and removes attributes, until its retained state is cleared
+#
+# Arguments after -- are passed to ha-mqtt-gateway.py, for example
+# "-- --subscribe-entities".  With --json the results are printed as a
+# JSON object, for comparison across versions.
+
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import hassim
+import mqttstub
+
+GATEWAY = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ha-mqtt-gateway.py')
+
+
+class Probe:
+    # Records the states that the gateway publishes to the broker
+    def __init__(self):
+        self.last_updated = {}
+        self.cleared = {}
+        self.reset()
+
+    def reset(self):
+        self.received = 0
+        self.latencies = []
+        self.last_arrival = None
+
+    def on_publish(self, topic, payload, retain):
+        if not topic.endswith('/state'):
+            return
+        now = time.time()
+        entity_id = topic.split('/')[-2]
+        if not payload:
+            self.cleared[entity_id] = now
+            return
+        lu = datetime.datetime.fromisoformat(json.loads(payload)['last_updated']).timestamp()
+        self.last_updated[entity_id] = lu
+        self.latencies.append(now - lu)
+        self.received += 1
+        self.last_arrival = now
+
+
+def memory(pid):
+    # VmRSS and VmHWM in MiB
+    result = {}
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            if key in ('VmRSS', 'VmHWM'):
+                result[key] = int(value.split()[0]) / 1024
+    return result
+
+
+async def wait_until(condition, timeout):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise TimeoutError
+        await asyncio.sleep(0.005)
+
+
+async def wait_idle(probe, count, idle):
+    # Wait until count states arrived, or none did for idle seconds
+    last = time.monotonic()
+    received = probe.received
+    while probe.received < count:
+        await asyncio.sleep(0.005)
+        if probe.received != received:
+            received = probe.received
+            last = time.monotonic()
+        elif time.monotonic() - last > idle:
+            break
+
+
+def percentiles(prefix, latencies):
+    if len(latencies) < 2:
+        return {}
+    q = statistics.quantiles(latencies, n=100, method='inclusive')
+    return {f'{prefix}_latency_p50': q[49], f'{prefix}_latency_p95': q[94],
+            f'{prefix}_latency_p99': q[98], f'{prefix}_latency_max': max(latencies)}
+
+
+async def bench_events(hass, probe, prefix, rate, count, idle):
+    probe.reset()
+    start = time.time()
+    elapsed = await hass.run_events(rate, count)
+    await wait_idle(probe, count, idle)
+    result = {
+        f'{prefix}_fired_per_s': count / elapsed,
+        f'{prefix}_delivered': probe.received,
+    }
+    if not probe.received:
+        print(f'{prefix}: no events were delivered', file=sys.stderr)
+    if probe.received:
+        drain = probe.last_arrival - start
+        result[f'{prefix}_events_per_s'] = probe.received / drain
+        result[f'{prefix}_drain_s'] = drain
+    result.update(percentiles(prefix, probe.latencies))
+    return result
+
+
+async def bench_reconnect(hass, probe, timeout):
+    subscribed = asyncio.Event()
+    hass.on_subscribe = lambda ws: subscribed.set()
+    entity_id = next(iter(hass.states))
+    start = time.time()
+    await hass.drop()
+    await asyncio.wait_for(subscribed.wait(), timeout)
+    resubscribed = time.time()
+
+    fired = time.time()
+    await hass.fire(dict(hass.states[entity_id], state='reconnected'))
+    await wait_until(lambda: probe.last_updated.get(entity_id, 0) >= fired - 0.001, timeout)
+    return {
+        'reconnect_subscribe_s': resubscribed - start,
+        'reconnect_recovery_s': probe.last_arrival - start,
+    }
+
+
+async def bench_remove(hass, probe, timeout):
+    entity_id = next(iter(hass.states))
+    state = hass.states[entity_id]
+    attributes = {k: v for k, v in state["attributes"].items() if k != "friendly_name"}
+    fired = time.time()
+    await hass.fire(dict(state, state='removing', attributes=dict(attributes, removing=True)))
+    await wait_until(lambda: probe.last_updated.get(entity_id, 0) >= fired - 0.001, timeout)
+
+    start = time.time()
+    await hass.remove(entity_id)
+    await wait_until(lambda: probe.cleared.get(entity_id, 0) >= start, timeout)
+    return {'remove_s': probe.cleared[entity_id] - start}
+
+
+async def run(args):
+    probe = Probe()
+    broker = mqttstub.Broker(probe.on_publish)
+    mqtt_server = await broker.start(port=0)
+    mqtt_port = mqtt_server.sockets[0].getsockname()[1]
+
+    hass = hassim.FakeHass(args.entities, replay=hassim.read_replay(args.replay) if args.replay else None)
+    authenticated = []
+    hass.on_auth = lambda ws: authenticated.append(time.time())
+    # the gateway ignores states that arrive before it is connected to MQTT
+    hass.ready.clear()
+    hass_server = await hass.start(port=0)
+    hass_port = hass_server.sockets[0].getsockname()[1]
+
+    with tempfile.NamedTemporaryFile('w') as token_file:
+        token_file.write(hass.token + '\n')
+        token_file.flush()
+        gateway = await asyncio.create_subprocess_exec(
+            sys.executable, GATEWAY, '-f', token_file.name, '-H', f'127.0.0.1:{mqtt_port}',
+            *args.gateway_args, f'127.0.0.1:{hass_port}',
+            stdout=None if args.verbose else subprocess.DEVNULL)
+
+        results = {}
+        try:
+            await wait_until(lambda: any(broker.subscriptions.values()), args.timeout)
+            results['rss_idle_mb'] = memory(gateway.pid)['VmRSS']
+            hass.ready.set()
+            await wait_until(lambda: len(probe.last_updated) >= len(hass.states), args.timeout)
+            mem = memory(gateway.pid)
+            results.update({
+                'entities': len(hass.states),
+                'dump_s': probe.last_arrival - authenticated[0],
+                'rss_after_dump_mb': mem['VmRSS'],
+                'rss_peak_mb': mem['VmHWM'],
+            })
+
+            results.update(await bench_events(hass, probe, 'steady', args.rate, args.events, args.idle))
+            results.update(await bench_events(hass, probe, 'burst', 0, args.burst, args.idle))
+            results.update(await bench_reconnect(hass, probe, args.timeout))
+            results.update(await bench_remove(hass, probe, args.timeout))
+        except TimeoutError:
+            print('timed out waiting for the gateway', file=sys.stderr)
+        finally:
+            if gateway.returncode is None:
+                gateway.terminate()
+            await gateway.wait()
+
+    mqtt_server.close()
+    hass_server.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark ha-mqtt-gateway.py against a fake Home Assistant.')
+    parser.add_argument('--entities', metavar='N', type=int, default=10000,
+                        help='number of synthetic sensors')
+    parser.add_argument('--replay', metavar='FILE', help='JSON lines file with state_changed events')
+    parser.add_argument('--rate', metavar='EVENTS', type=float, default=1000,
+                        help='events per second for the steady state benchmark')
+    parser.add_argument('--events', metavar='N', type=int, default=10000,
+                        help='events for the steady state benchmark')
+    parser.add_argument('--burst', metavar='N', type=int, default=5000,
+                        help='events for the burst benchmark')
+    parser.add_argument('--idle', metavar='SECONDS', type=float, default=2,
+                        help='stop waiting for events after this long without any')
+    parser.add_argument('--timeout', metavar='SECONDS', type=float, default=60,
+                        help='timeout for the gateway to connect and publish the initial states')
+    parser.add_argument('--verbose', action='store_true', help="show the gateway's output")
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    parser.add_argument('gateway_args', metavar='GATEWAY_ARGS', nargs='*',
+                        help='arguments for ha-mqtt-gateway.py (after --)')
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(results))
+    else:
+        for k, v in results.items():
+            print(f'{k:24} {v:.6g}')
+    if any(k.endswith('_delivered') and not v for k, v in results.items()):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,308 @@
+#! /usr/bin/env python3
+
+# Author: Paolo Bonzini
+# Licensed under AGPLv3.
+
+# Fake Home Assistant websocket API, to run ha-mqtt-gateway.py without
+# Home Assistant.
+#
+# The server implements the part of the protocol that the gateway uses:
+# authentication, get_states, subscribe_events, subscribe_entities and
+# call_service.  It has a set of synthetic sensors (--entities) and can
+# fire state_changed events for them at a given rate:
+#
+#   ./hassim.py --port 8123 --entities 10000 --rate 1000
+#   ha-mqtt-gateway.py -f token.txt localhost:8123
+#
+# With --replay, the new states come from a file with one state_changed
+# event per line (either the "event" object or the whole websocket
+# message), in a loop.  Either way, last_changed and last_updated are set
+# to the time the event is sent, so that the latency can be computed from
+# the states that the gateway publishes.  call_service always succeeds
+# and fires a state_changed event for each target entity.
+#
+# subscribe_entities clients get the same changes as compressed diffs,
+# including added and removed attributes; remove() deletes an entity,
+# which sends a state_changed event with a null new_state and an "r"
+# diff.
+
+import argparse
+import asyncio
+import datetime
+import itertools
+import json
+import time
+import websockets
+from websockets.asyncio.server import serve
+
+
+def now_iso():
+    return datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+
+def synthetic_state(i, value=0):
+    when = now_iso()
+    return {
+        "entity_id": f"sensor.bench_{i}",
+        "state": str(value),
+        "attributes": {
+            "unit_of_measurement": "W",
+            "device_class": "power",
+            "state_class": "measurement",
+            "friendly_name": f"Bench sensor {i}",
+        },
+        "last_changed": when,
+        "last_updated": when,
+        "context": {"id": f"{i:026}", "parent_id": None, "user_id": None},
+    }
+
+
+def read_replay(path):
+    states = []
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            event = json.loads(line)
+            event = event.get("event", event)
+            new_state = event.get("data", {}).get("new_state")
+            if new_state:
+                states.append(new_state)
+    return states
+
+
+def compressed_state(state):
+    # subscribe_entities format
+    return {
+        "s": state["state"],
+        "a": state["attributes"],
+        "c": state["context"]["id"],
+        "lc": datetime.datetime.fromisoformat(state["last_changed"]).timestamp(),
+    }
+
+
+class FakeHass:
+    def __init__(self, entities=1000, token="bench", replay=None):
+        self.token = token
+        self.states = {}
+        for i in range(entities):
+            state = synthetic_state(i)
+            self.states[state["entity_id"]] = state
+        self.replay = replay or []
+        for state in self.replay:
+            self.states.setdefault(state["entity_id"], dict(state))
+        self.connections = set()
+        self.event_subscribers = {}
+        self.entity_subscribers = {}
+        self.fired = 0
+        # shared by all run_events calls, so that each one sends new values
+        self.states_iter = None
+        # cleared to hold off clients before authentication
+        self.ready = asyncio.Event()
+        self.ready.set()
+        # hooks for benchmarks, called with the websocket
+        self.on_auth = None
+        self.on_subscribe = None
+
+    async def send_result(self, ws, msg_id, result=None):
+        await ws.send(json.dumps({"id": msg_id, "type": "result", "success": True, "result": result}))
+
+    async def handle(self, ws):
+        await self.ready.wait()
+        await ws.send(json.dumps({"type": "auth_required", "ha_version": "2024.1.0"}))
+        msg = json.loads(await ws.recv())
+        if msg.get("access_token") != self.token:
+            await ws.send(json.dumps({"type": "auth_invalid", "message": "Invalid access token"}))
+            return
+        await ws.send(json.dumps({"type": "auth_ok", "ha_version": "2024.1.0"}))
+        if self.on_auth:
+            self.on_auth(ws)
+
+        self.connections.add(ws)
+        try:
+            async for message in ws:
+                msg = json.loads(message)
+                if msg["type"] == "get_states":
+                    await self.send_result(ws, msg["id"], list(self.states.values()))
+                elif msg["type"] == "subscribe_events":
+                    await self.send_result(ws, msg["id"])
+                    if msg.get("event_type", "state_changed") == "state_changed":
+                        self.event_subscribers[ws] = msg["id"]
+                        if self.on_subscribe:
+                            self.on_subscribe(ws)
+                elif msg["type"] == "subscribe_entities":
+                    await self.send_result(ws, msg["id"])
+                    added = {k: compressed_state(v) for k, v in self.states.items()}
+                    await ws.send(json.dumps({"id": msg["id"], "type": "event", "event": {"a": added}}))
+                    self.entity_subscribers[ws] = msg["id"]
+                    if self.on_subscribe:
+                        self.on_subscribe(ws)
+                elif msg["type"] == "call_service":
+                    await self.send_result(ws, msg["id"], {"context": {"id": str(msg["id"])}})
+                    for entity_id in self.targets(msg):
+                        await self.fire(self.service_state(entity_id, msg))
+                else:
+                    await self.send_result(ws, msg["id"])
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        finally:
+            self.connections.discard(ws)
+            self.event_subscribers.pop(ws, None)
+            self.entity_subscribers.pop(ws, None)
+
+    def targets(self, msg):
+        entity_ids = msg.get("target", {}).get("entity_id", [])
+        if isinstance(entity_ids, str):
+            entity_ids = [entity_ids]
+        return entity_ids
+
+    def service_state(self, entity_id, msg):
+        state = dict(self.states.get(entity_id) or synthetic_state(0))
+        state["entity_id"] = entity_id
+        service = msg["service"]
+        if service in ("turn_on", "turn_off"):
+            state["state"] = service[5:]
+        elif service == "toggle":
+            state["state"] = "off" if state["state"] == "on" else "on"
+        elif "value" in msg.get("service_data", {}):
+            state["state"] = str(msg["service_data"]["value"])
+        return state
+
+    async def send_state_changed(self, entity_id, old_state, new_state, when):
+        context = (new_state or old_state)["context"]
+        for ws, sub_id in list(self.event_subscribers.items()):
+            try:
+                await ws.send(json.dumps({
+                    "id": sub_id, "type": "event",
+                    "event": {
+                        "event_type": "state_changed",
+                        "data": {"entity_id": entity_id, "old_state": old_state, "new_state": new_state},
+                        "origin": "LOCAL",
+                        "time_fired": when,
+                        "context": context,
+                    }}))
+            except websockets.exceptions.ConnectionClosed:
+                pass
+
+    async def send_entities_event(self, event):
+        message = json.dumps({"type": "event", "event": event})
+        for ws, sub_id in list(self.entity_subscribers.items()):
+            try:
+                await ws.send(f'{{"id":{sub_id},{message[1:]}')
+            except websockets.exceptions.ConnectionClosed:
+                pass
+
+    def entity_diff(self, old_state, new_state, when):
+        # subscribe_entities format of a change
+        added = {"s": new_state["state"], "c": new_state["context"]["id"]}
+        added["lc" if new_state["last_changed"] == when else "lu"] = \
+            datetime.datetime.fromisoformat(when).timestamp()
+        diff = {"+": added}
+        old_attributes = old_state["attributes"]
+        attributes = new_state["attributes"]
+        if attributes is not old_attributes:
+            changed = {k: v for k, v in attributes.items()
+                       if k not in old_attributes or old_attributes[k] != v}
+            if changed:
+                added["a"] = changed
+            removed = [k for k in old_attributes if k not in attributes]
+            if removed:
+                diff["-"] = {"a": removed}
+        return diff
+
+    async def fire(self, new_state):
+        when = now_iso()
+        new_state = dict(new_state, last_updated=when)
+        entity_id = new_state["entity_id"]
+        old_state = self.states.get(entity_id)
+        if old_state is None or old_state["state"] != new_state["state"]:
+            new_state["last_changed"] = when
+        self.states[entity_id] = new_state
+        self.fired += 1
+
+        await self.send_state_changed(entity_id, old_state, new_state, when)
+        if self.entity_subscribers:
+            if old_state is None:
+                event = {"a": {entity_id: compressed_state(new_state)}}
+            else:
+                event = {"c": {entity_id: self.entity_diff(old_state, new_state, when)}}
+            await self.send_entities_event(event)
+
+    async def remove(self, entity_id):
+        # Delete an entity, as Home Assistant does when it is removed
+        old_state = self.states.pop(entity_id)
+        self.fired += 1
+        await self.send_state_changed(entity_id, old_state, None, now_iso())
+        if self.entity_subscribers:
+            await self.send_entities_event({"r": [entity_id]})
+
+    def next_states(self):
+        # Replayed states, or a new value for each synthetic sensor in turn
+        if self.replay:
+            yield from itertools.cycle(self.replay)
+        synthetic = [s for s in self.states.values() if s["entity_id"].startswith("sensor.bench_")]
+        for value in itertools.count(1):
+            for state in synthetic:
+                yield dict(state, state=str(value))
+
+    async def run_events(self, rate=0, count=None):
+        # Fire count events (forever if None) at rate events per second,
+        # or as fast as possible if rate is 0
+        if self.states_iter is None:
+            self.states_iter = self.next_states()
+        states = self.states_iter
+        start = time.monotonic()
+        sent = 0
+        while count is None or sent < count:
+            if rate:
+                due = int((time.monotonic() - start) * rate) + 1
+                if sent >= due:
+                    await asyncio.sleep(min(0.01, (sent + 1 - due) / rate))
+                    continue
+            else:
+                due = sent + 100
+            if count is not None:
+                due = min(due, count)
+            while sent < due:
+                await self.fire(next(states))
+                sent += 1
+            await asyncio.sleep(0)
+        return time.monotonic() - start
+
+    async def drop(self):
+        # Close all connections, to test reconnection
+        for ws in list(self.connections):
+            await ws.close()
+
+    async def start(self, host="127.0.0.1", port=8123):
+        # permessage-deflate is left out to keep the simulator cheap
+        return await serve(self.handle, host, port, max_size=None, compression=None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake Home Assistant websocket API.')
+    parser.add_argument('--port', metavar='PORT', type=int, default=8123, help='TCP port')
+    parser.add_argument('--token', default='bench', help='access token to accept')
+    parser.add_argument('--entities', metavar='N', type=int, default=1000,
+                        help='number of synthetic sensors')
+    parser.add_argument('--replay', metavar='FILE', help='JSON lines file with state_changed events')
+    parser.add_argument('--rate', metavar='EVENTS', type=float, default=10,
+                        help='state_changed events per second (0 for as fast as possible)')
+    parser.add_argument('--count', metavar='N', type=int, help='stop firing events after N')
+    args = parser.parse_args()
+
+    async def run():
+        hass = FakeHass(args.entities, args.token, read_replay(args.replay) if args.replay else None)
+        server = await hass.start(port=args.port)
+        print(f"listening on port {args.port}, {len(hass.states)} entities", flush=True)
+        await hass.run_events(args.rate, args.count)
+        await server.serve_forever()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+#! /usr/bin/env python3
+
+# Author: Paolo Bonzini
+# Licensed under AGPLv3.
+
+# Minimal MQTT 3.1.1 broker, standing in for mosquitto in benchmarks.
+#
+# Only what ha-mqtt-gateway.py and ensolar2.py use is implemented: QoS 0
+# (QoS 1 publishes are acknowledged but delivered at QoS 0), retained
+# messages, wildcard subscriptions and keepalive pings.  Wills, sessions
+# and authentication are ignored.  The on_publish hook is called for every
+# message that a client publishes.
+
+import argparse
+import asyncio
+import time
+
+CONNACK = b'\x20\x02\x00\x00'
+PINGRESP = b'\xd0\x00'
+
+
+def topic_matches(pattern, topic):
+    pattern = pattern.split('/')
+    topic = topic.split('/')
+    for i, level in enumerate(pattern):
+        if level == '#':
+            return True
+        if i >= len(topic) or (level != '+' and level != topic[i]):
+            return False
+    return len(pattern) == len(topic)
+
+
+def encode_length(n):
+    out = bytearray()
+    while True:
+        byte = n % 128
+        n //= 128
+        out.append(byte | 0x80 if n else byte)
+        if not n:
+            return bytes(out)
+
+
+def encode_string(s):
+    return len(s).to_bytes(2, 'big') + s
+
+
+def publish_packet(topic, payload, retain=False):
+    body = encode_string(topic) + payload
+    return bytes([0x31 if retain else 0x30]) + encode_length(len(body)) + body
+
+
+class Broker:
+    def __init__(self, on_publish=None):
+        self.on_publish = on_publish
+        self.subscriptions = dict()
+        self.retained = dict()
+        self.messages = 0
+
+    async def read_packet(self, reader):
+        header = (await reader.readexactly(1))[0]
+        length = 0
+        shift = 0
+        while True:
+            byte = (await reader.readexactly(1))[0]
+            length += (byte & 0x7f) << shift
+            shift += 7
+            if not byte & 0x80:
+                break
+        return header, await reader.readexactly(length)
+
+    def publish(self, topic, payload, retain):
+        self.messages += 1
+        if retain:
+            if payload:
+                self.retained[topic] = payload
+            else:
+                self.retained.pop(topic, None)
+        if self.on_publish:
+            self.on_publish(topic.decode(), payload, retain)
+        packet = None
+        name = topic.decode()
+        for writer, patterns in self.subscriptions.items():
+            if any(topic_matches(p, name) for p in patterns):
+                packet = packet or publish_packet(topic, payload)
+                writer.write(packet)
+
+    def subscribe(self, writer, body):
+        packet_id, pos = body[:2], 2
+        granted = bytearray()
+        while pos < len(body):
+            n = int.from_bytes(body[pos:pos + 2], 'big')
+            pattern = body[pos + 2:pos + 2 + n].decode()
+            pos += 3 + n
+            self.subscriptions[writer].append(pattern)
+            granted.append(0)
+            for topic, payload in self.retained.items():
+                if topic_matches(pattern, topic.decode()):
+                    writer.write(publish_packet(topic, payload, retain=True))
+        writer.write(b'\x90' + encode_length(2 + len(granted)) + packet_id + granted)
+
+    async def handle(self, reader, writer):
+        self.subscriptions[writer] = []
+        try:
+            while True:
+                header, body = await self.read_packet(reader)
+                kind = header >> 4
+                if kind == 1:
+                    writer.write(CONNACK)
+                elif kind == 3:
+                    n = int.from_bytes(body[:2], 'big')
+                    topic = body[2:2 + n]
+                    pos = 2 + n
+                    qos = (header >> 1) & 3
+                    if qos:
+                        writer.write(b'\x40\x02' + body[pos:pos + 2])
+                        pos += 2
+                    self.publish(topic, body[pos:], header & 1)
+                elif kind == 8:
+                    self.subscribe(writer, body)
+                elif kind == 12:
+                    writer.write(PINGRESP)
+                elif kind == 14:
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            del self.subscriptions[writer]
+            writer.close()
+
+    async def start(self, host='127.0.0.1', port=1883):
+        return await asyncio.start_server(self.handle, host, port)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Minimal MQTT broker for benchmarks.')
+    parser.add_argument('--port', metavar='PORT', type=int, default=1883, help='TCP port')
+    parser.add_argument('--verbose', action='store_true', help='print the messages')
+    args = parser.parse_args()
+
+    def on_publish(topic, payload, retain):
+        print(f'{time.time():.6f}', topic, payload.decode(errors='replace'))
+
+    async def run():
+        broker = Broker(on_publish if args.verbose else None)
+        server = await broker.start(port=args.port)
+        await server.serve_forever()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
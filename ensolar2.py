@@ -20,69 +20,99 @@
 #   the array?
 
 from collections import defaultdict, namedtuple
-from pymodbus.client.sync import ModbusSerialClient
-from pymodbus.exceptions import ModbusException
+from ensolar2log import BinaryLogWriter, Compactor, DailyLog
+from operator import itemgetter
+from pymodbus.client.sync import ModbusSerialClient, ModbusTcpClient
+from pymodbus.exceptions import ModbusException, ModbusIOException
+from pymodbus.transaction import ModbusRtuFramer
 import argparse
+import array
+import asyncio
+import concurrent.futures
 import itertools
+import json
+import math
+import metrics
 import os
 import paho.mqtt.client
+import struct
 import sys
 import time
 
-class InputRegConversion(namedtuple('InputRegConversion', ['index', 'factor'])):
+# Sampling classes.  Power readings are needed for load control and are
+# read as often as the bus allows; alarms are read at a medium rate, and
+# slowly-changing values such as the date and the energy counters only
+# every few minutes.
+FAST = 'fast'
+MEDIUM = 'medium'
+SLOW = 'slow'
+
+TIER_PERIODS = {FAST: 5, MEDIUM: 30, SLOW: 300}
+
+# Values that could not be read for this many periods of their tier
+# are dropped, and read as zero
+STALE_PERIODS = 3
+
+MODBUS_LATENCY = metrics.Histogram('ensolar2_modbus_request_seconds',
+                                   'Modbus request latency', ['device', 'block'])
+MODBUS_ERRORS = metrics.Counter('ensolar2_modbus_errors_total',
+                                'failed Modbus requests (timeout includes CRC errors)',
+                                ['device', 'kind'])
+MODBUS_RECONNECTS = metrics.Counter('ensolar2_modbus_reconnects_total',
+                                    'Modbus connections reopened after a failure', ['device'])
+BUS_UTILIZATION = metrics.Gauge('ensolar2_modbus_planned_utilization',
+                                'fraction of time that the polling plan keeps the bus busy',
+                                ['device'])
+LOG_WRITE = metrics.Histogram('ensolar2_log_write_seconds', 'time to write a log row', ['format'])
+MQTT_PUBLISH = metrics.Histogram('ensolar2_mqtt_publish_seconds', 'time to publish a sample to MQTT')
+
+class InputRegConversion(namedtuple('InputRegConversion', ['index', 'factor', 'tier'])):
     __slots__ = ()
-    def __call__(self, rr):
-        index = self.index
-        val = rr.registers[index]
-        if val > 32767:
-            val = val - 65536
-        return val if self.factor is None else val * self.factor
-    
-class DiscreteInpConversion(namedtuple('DiscreteInpConversion', ['index', 'alert'])):
+
+class DiscreteInpConversion(namedtuple('DiscreteInpConversion', ['index', 'alert', 'tier'],
+                                       defaults=[MEDIUM])):
     __slots__ = ()
-    def __call__(self, rr):
-        return rr.bits[self.index]
 
 INPUT_REGS = {
-    'TEMP': InputRegConversion(factor=0.1, index=0),     # Temperature
-    'VER': InputRegConversion(factor=0.01, index=1),     # Version
-    'DATM': InputRegConversion(factor=None, index=2),    # Year/Month
-    'DADH': InputRegConversion(factor=None, index=3),    # Day/Hour
-    'DAMS': InputRegConversion(factor=None, index=4),    # Minute/Second
-    'BATS': InputRegConversion(factor=None, index=5),    # Battery status
-    'BATV': InputRegConversion(factor=0.1, index=6),     # Battery voltage
-    'BATA': InputRegConversion(factor=0.1, index=7),     # Battery current
-    'INPH': InputRegConversion(factor=0.01, index=8),    # Input frequency
-    'INPV': InputRegConversion(factor=0.1, index=9),     # Input voltage
-    'INPAP': InputRegConversion(factor=None, index=10),  # Input apparent power
-    'INPW': InputRegConversion(factor=None, index=11),   # Input power
-    'INVH': InputRegConversion(factor=0.01, index=12),   # Inverter frequency
-    'INVV': InputRegConversion(factor=0.1, index=13),    # Inverter voltage
-    'INVA': InputRegConversion(factor=0.1, index=14),    # Inverter current
-    'INVW': InputRegConversion(factor=None, index=15),   # Inverter power
-    'PVV': InputRegConversion(factor=0.1, index=16),     # PV voltage
-    'PVA': InputRegConversion(factor=0.1, index=17),     # PV current
-    'PVW': InputRegConversion(factor=1, index=18),       # PV power
-    'BUSV': InputRegConversion(factor=0.1, index=19),    # Bus voltage
-    'SGCL': InputRegConversion(factor=0.01, index=20),   # Daily PV gen (kWh)
-    'SGCH': InputRegConversion(factor=0.01, index=21),   #   (can be reset on LCD panel)
-    'STCL': InputRegConversion(factor=0.01, index=22),   # Tot PV gen (kWh)
-    'STCH': InputRegConversion(factor=0.01, index=23),   #   (can be reset on LCD panel)
-    'LOADV': InputRegConversion(factor=0.1, index=24),   # Backup load voltage
-    'LOADA': InputRegConversion(factor=0.1, index=25),   # Backup load voltage
-    'LOADW': InputRegConversion(factor=1, index=26),     # Backup load power
-    'LOADAP': InputRegConversion(factor=1, index=27),    # Backup load apparent power
-    'LOADP': InputRegConversion(factor=0.1, index=28),   # Backup load %
-    'SOC': InputRegConversion(factor=1, index=33),       # ?? SOC
-    'AMMV': InputRegConversion(factor=0.1, index=65),    # Ammeter voltage
-    'TEEH': InputRegConversion(factor=0.01, index=66),   # Total Electric Energy (kWh, actually low)
-    'TEEL': InputRegConversion(factor=0.01, index=67),   #   (actually high)
-    'PEH': InputRegConversion(factor=0.01, index=68),    # Positive Energy (kWh, actually low)
-    'PEL': InputRegConversion(factor=0.01, index=69),    #   (actually high)
-    'NEH': InputRegConversion(factor=0.01, index=70),    # Negative Energy (kWh, actually low)
-    'NEL': InputRegConversion(factor=0.01, index=71),    #   (actually high)
-    'YADAI': InputRegConversion(factor=0.001, index=72), # ?? Instant YADA (current)
-    'YADAP': InputRegConversion(factor=0.1, index=74)    # Grid balance
+    'TEMP': InputRegConversion(factor=0.1, index=0, tier=MEDIUM),     # Temperature
+    'VER': InputRegConversion(factor=0.01, index=1, tier=SLOW),       # Version
+    'DATM': InputRegConversion(factor=None, index=2, tier=SLOW),      # Year/Month
+    'DADH': InputRegConversion(factor=None, index=3, tier=SLOW),      # Day/Hour
+    'DAMS': InputRegConversion(factor=None, index=4, tier=SLOW),      # Minute/Second
+    'BATS': InputRegConversion(factor=None, index=5, tier=FAST),      # Battery status
+    'BATV': InputRegConversion(factor=0.1, index=6, tier=FAST),       # Battery voltage
+    'BATA': InputRegConversion(factor=0.1, index=7, tier=FAST),       # Battery current
+    'INPH': InputRegConversion(factor=0.01, index=8, tier=MEDIUM),    # Input frequency
+    'INPV': InputRegConversion(factor=0.1, index=9, tier=MEDIUM),     # Input voltage
+    'INPAP': InputRegConversion(factor=None, index=10, tier=MEDIUM),  # Input apparent power
+    'INPW': InputRegConversion(factor=None, index=11, tier=FAST),     # Input power
+    'INVH': InputRegConversion(factor=0.01, index=12, tier=MEDIUM),   # Inverter frequency
+    'INVV': InputRegConversion(factor=0.1, index=13, tier=MEDIUM),    # Inverter voltage
+    'INVA': InputRegConversion(factor=0.1, index=14, tier=MEDIUM),    # Inverter current
+    'INVW': InputRegConversion(factor=None, index=15, tier=FAST),     # Inverter power
+    'PVV': InputRegConversion(factor=0.1, index=16, tier=MEDIUM),     # PV voltage
+    'PVA': InputRegConversion(factor=0.1, index=17, tier=MEDIUM),     # PV current
+    'PVW': InputRegConversion(factor=1, index=18, tier=FAST),         # PV power
+    'BUSV': InputRegConversion(factor=0.1, index=19, tier=MEDIUM),    # Bus voltage
+    'SGCL': InputRegConversion(factor=0.01, index=20, tier=SLOW),     # Daily PV gen (kWh)
+    'SGCH': InputRegConversion(factor=0.01, index=21, tier=SLOW),     #   (can be reset on LCD panel)
+    'STCL': InputRegConversion(factor=0.01, index=22, tier=SLOW),     # Tot PV gen (kWh)
+    'STCH': InputRegConversion(factor=0.01, index=23, tier=SLOW),     #   (can be reset on LCD panel)
+    'LOADV': InputRegConversion(factor=0.1, index=24, tier=MEDIUM),   # Backup load voltage
+    'LOADA': InputRegConversion(factor=0.1, index=25, tier=MEDIUM),   # Backup load voltage
+    'LOADW': InputRegConversion(factor=1, index=26, tier=MEDIUM),     # Backup load power
+    'LOADAP': InputRegConversion(factor=1, index=27, tier=MEDIUM),    # Backup load apparent power
+    'LOADP': InputRegConversion(factor=0.1, index=28, tier=MEDIUM),   # Backup load %
+    'SOC': InputRegConversion(factor=1, index=33, tier=MEDIUM),       # ?? SOC
+    'AMMV': InputRegConversion(factor=0.1, index=65, tier=MEDIUM),    # Ammeter voltage
+    'TEEH': InputRegConversion(factor=0.01, index=66, tier=SLOW),     # Total Electric Energy (kWh, actually low)
+    'TEEL': InputRegConversion(factor=0.01, index=67, tier=SLOW),     #   (actually high)
+    'PEH': InputRegConversion(factor=0.01, index=68, tier=SLOW),      # Positive Energy (kWh, actually low)
+    'PEL': InputRegConversion(factor=0.01, index=69, tier=SLOW),      #   (actually high)
+    'NEH': InputRegConversion(factor=0.01, index=70, tier=SLOW),      # Negative Energy (kWh, actually low)
+    'NEL': InputRegConversion(factor=0.01, index=71, tier=SLOW),      #   (actually high)
+    'YADAI': InputRegConversion(factor=0.001, index=72, tier=MEDIUM), # ?? Instant YADA (current)
+    'YADAP': InputRegConversion(factor=0.1, index=74, tier=FAST)      # Grid balance
 }
 
 DISCRETE_INP = {
@@ -187,9 +217,118 @@ FIELDS = [
   "RULE0", "RULE1", "RULE2", "RULE3", "RULE4", "RULE5", "RULE6", "RULE7",
 ]
 
-MAX_REG = max((x.index for x in INPUT_REGS.values()))
-MAX_DI = max((x.index for x in DISCRETE_INP.values()))
-MAX_DI = (MAX_DI + 7) & ~8
+# Modbus RTU framing, used to estimate the cost of a read.  Characters
+# are 10 bits long (8N1) and frames are separated by 3.5 characters of
+# silence; the turnaround is a guess at how long the inverter takes to
+# start answering.
+RTU_CHAR_BITS = 10
+RTU_FRAME_GAP = 3.5
+RTU_REQUEST_BYTES = 8       # unit, function, address, count, CRC
+RTU_RESPONSE_BYTES = 5      # unit, function, byte count, CRC
+RTU_TURNAROUND = 0.05
+MAX_READ_REGS = 125
+MAX_READ_BITS = 2000
+
+class InputRegDecoder:
+    # The registers are packed as unsigned and unpacked as signed, skipping
+    # the ones that are not used, with a single precompiled struct.
+    def __init__(self, start, count, convs):
+        convs = sorted(convs.items(), key=lambda x: x[1].index)
+        fmt = '='
+        pos = start
+        for name, conv in convs:
+            fmt += 'xx' * (conv.index - pos) + 'h'
+            pos = conv.index + 1
+        self.pack = struct.Struct('=%dH' % count).pack
+        self.unpack = struct.Struct(fmt).unpack_from
+        self.names = tuple(name for name, conv in convs)
+        self.factors = tuple(1 if conv.factor is None else conv.factor for name, conv in convs)
+
+    def __call__(self, rr):
+        raw = self.unpack(self.pack(*rr.registers))
+        return dict(zip(self.names, [v * f for v, f in zip(raw, self.factors)]))
+
+class DiscreteInpDecoder:
+    def __init__(self, start, count, convs):
+        convs = sorted(convs.items(), key=lambda x: x[1].index)
+        self.names = tuple(name for name, conv in convs)
+        self.get = itemgetter(*(conv.index - start for name, conv in convs))
+        if len(convs) == 1:
+            get = self.get
+            self.get = lambda bits: (get(bits),)
+
+    def __call__(self, rr):
+        return dict(zip(self.names, self.get(rr.bits)))
+
+class ReadBlock(namedtuple('ReadBlock', ['function', 'start', 'count', 'bytes', 'decode'])):
+    __slots__ = ()
+
+    def __str__(self):
+        kind = 'input registers' if self.function == 'read_input_registers' else 'discrete inputs'
+        return f'{kind} {self.start}-{self.start + self.count - 1} ({self.count})'
+
+class ReadPlan:
+    def __init__(self, blocks, baudrate, request_delay):
+        self.blocks = blocks
+        self.baudrate = baudrate
+        self.request_delay = request_delay
+
+    def block_duration(self, block):
+        char_time = RTU_CHAR_BITS / self.baudrate
+        return (block.bytes + 2 * RTU_FRAME_GAP) * char_time + RTU_TURNAROUND + self.request_delay
+
+    @property
+    def bytes(self):
+        return sum(block.bytes for block in self.blocks)
+
+    @property
+    def duration(self):
+        return sum(self.block_duration(block) for block in self.blocks)
+
+    def describe(self):
+        for block in self.blocks:
+            yield f'{block}: {block.bytes} bytes, {self.block_duration(block):.3f} s'
+        yield f'total: {len(self.blocks)} requests, {self.bytes} bytes, {self.duration:.3f} s'
+
+def coalesce(indices, unit_cost, overhead, max_count):
+    # Extend the current block across a gap as long as transferring the
+    # unused items is cheaper than starting a new request.
+    blocks = []
+    for i in sorted(set(indices)):
+        if blocks:
+            start, end = blocks[-1]
+            if i - start < max_count and (i - end - 1) * unit_cost <= overhead:
+                blocks[-1] = (start, i)
+                continue
+        blocks.append((i, i))
+    return blocks
+
+def plan_reads(input_regs=INPUT_REGS, discrete_inp=DISCRETE_INP,
+               baudrate=2400, request_delay=0):
+    # Per-request overhead, in characters on the bus
+    char_time = RTU_CHAR_BITS / baudrate
+    overhead = (RTU_REQUEST_BYTES + RTU_RESPONSE_BYTES + 2 * RTU_FRAME_GAP +
+                (RTU_TURNAROUND + request_delay) / char_time)
+
+    blocks = []
+    for start, end in coalesce((x.index for x in input_regs.values()), 2, overhead, MAX_READ_REGS):
+        count = end - start + 1
+        convs = { k: v for k, v in input_regs.items() if start <= v.index <= end }
+        blocks.append(ReadBlock('read_input_registers', start, count,
+                                RTU_REQUEST_BYTES + RTU_RESPONSE_BYTES + 2 * count,
+                                InputRegDecoder(start, count, convs)))
+
+    for start, end in coalesce((x.index for x in discrete_inp.values()), 1/8, overhead, MAX_READ_BITS):
+        count = end - start + 1
+        convs = { k: v for k, v in discrete_inp.items() if start <= v.index <= end }
+        blocks.append(ReadBlock('read_discrete_inputs', start, count,
+                                RTU_REQUEST_BYTES + RTU_RESPONSE_BYTES + (count + 7) // 8,
+                                DiscreteInpDecoder(start, count, convs)))
+
+    return ReadPlan(blocks, baudrate, request_delay)
+
+# Fields that are never filled in, and are logged as zeros
+CONSTANT_FIELDS = set(FIELDS) - set(INPUT_REGS) - set(DISCRETE_INP) - set(CALC_FIELDS)
 
 def format_field(val):
     if isinstance(val, float):
@@ -201,49 +340,494 @@ def format_field(val):
 def format_fields(regs):
     return [str(format_field(regs.get(f, 0))) for f in FIELDS]
 
-def output_fields(regs):
-    out = format_fields(regs)
-    fname = time.strftime('%Y%m%dVL.csv')
-    header = not os.path.exists(fname)
-    with open(fname, 'a') as f:
-        if header:
-            print(','.join(FIELDS), file=f)
-        print(','.join(out), file=f)
-
-def merge_fields(regs, snapshot):
-    for k, v in snapshot.items():
-        if v is not False:
-            regs[k] = v
-
-def modbus_read():
+class CsvLogWriter(DailyLog):
+    # Rows are formatted with a precompiled template, where the columns
+    # that are never filled in (inputs, outputs and rules) are constant zeros.
+    suffix = 'VL.csv'
+
+    def __init__(self, directory='.', fields=FIELDS, **kwargs):
+        super().__init__(directory, **kwargs)
+        self.fields = fields
+        self.template = ','.join('0' if f in CONSTANT_FIELDS else '{}' for f in fields) + '\n'
+        self.live = [f for f in fields if f not in CONSTANT_FIELDS]
+
+    def header(self):
+        return ','.join(self.fields) + '\n'
+
+    def format(self, regs):
+        get = regs.get
+        return self.template.format(*[format_field(get(f, 0)) for f in self.live])
+
+    def write(self, regs):
+        self.append(regs['TS'] / 1000, self.format(regs))
+
+# Types of the calculated fields in the binary log; the others are floats
+BINARY_CALC_TYPES = {'TS': 'q', 'MOTD': 'h', 'RPI': 'h', 'XYADA': 'bit', 'XGRIN': 'bit'}
+
+def binary_log_writer(directory='.', fields=FIELDS, **kwargs):
+    columns = []
+    bits = []
+    constants = {}
+    for f in fields:
+        if f in INPUT_REGS:
+            columns.append({'name': f, 'type': 'h', 'scale': INPUT_REGS[f].factor})
+        elif f in DISCRETE_INP or BINARY_CALC_TYPES.get(f) == 'bit':
+            bits.append(f)
+        elif f in CONSTANT_FIELDS:
+            constants[f] = 0
+        else:
+            columns.append({'name': f, 'type': BINARY_CALC_TYPES.get(f, 'f')})
+    columns.append({'name': 'BITS', 'type': 'Q', 'bits': bits})
+    return BinaryLogWriter(fields, columns, constants, directory, **kwargs)
+
+ENERGY_FIELDS = ['buy', 'sell', 'pv', 'charge', 'discharge', 'home', 'overhead']
+
+def energy_balance(regs):
+    # Power flows of a log row, with the same formulas as analysis/pvanalysis.py
+    invw = regs.get('INVW', 0)
+    net = regs.get('XGR', 0)
+    pv = regs.get('XPV', 0)
+    bt = regs.get('XBT', 0)
+    load = regs.get('XHOME', 0)
+    buy, sell = (net, 0) if net > 0 else (0, -net)
+    charge, discharge = (bt, 0) if bt > 0 else (0, -bt)
+    if invw <= 0:
+        overhead = -invw
+    elif discharge:
+        overhead = load - regs.get('XAUTO', 0)
+    else:
+        overhead = (buy + pv) - (sell + load + charge)
+    home = buy + (discharge or pv) - (sell + charge + overhead)
+    return dict(zip(ENERGY_FIELDS, [buy, sell, pv, charge, discharge, home, overhead]))
+
+class EnergyRollups:
+    # Hourly and daily energy (kWh) for the current calendar day, updated
+    # with each row of the log.  The totals are checkpointed next to the
+    # day's CSV file, so that a restart resumes the day without reading
+    # the log again, and other programs can read them from there.
+    suffix = 'VL.json'
+
+    def __init__(self, directory='.'):
+        self.directory = directory
+        self.day = None
+
+    def path(self, day):
+        return os.path.join(self.directory, day + self.suffix)
+
+    def load(self, day):
+        self.day = day
+        self.rows = 0
+        self.daily = dict.fromkeys(ENERGY_FIELDS, 0)
+        self.hourly = [dict.fromkeys(ENERGY_FIELDS, 0) for h in range(24)]
+        try:
+            with open(self.path(day)) as f:
+                data = json.load(f)
+            rows, daily, hourly = data['rows'], data['daily'], data['hourly']
+        except FileNotFoundError:
+            return
+        except (ValueError, KeyError, TypeError) as e:
+            # e.g. truncated by a power failure
+            print(f'cannot load {self.path(day)} ({e}), starting the day from zero', file=sys.stderr)
+            return
+        self.rows, self.daily, self.hourly = rows, daily, hourly
+
+    def save(self):
+        path = self.path(self.day)
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'rows': self.rows, 'daily': self.daily, 'hourly': self.hourly}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+
+    def add(self, regs, hours=5/60):
+        tm = time.localtime(regs['TS'] / 1000)
+        day = time.strftime('%Y%m%d', tm)
+        if day != self.day:
+            self.load(day)
+
+        hourly = self.hourly[tm.tm_hour]
+        for k, v in energy_balance(regs).items():
+            kwh = v * hours / 1000
+            hourly[k] += kwh
+            self.daily[k] += kwh
+        self.rows += 1
+        self.save()
+
+# Registers that are enumerations, dates or versions; the others are
+# analog values, and so are the calculated fields that are neither
+# booleans nor timestamps.
+ENUM_REGS = {'VER', 'DATM', 'DADH', 'DAMS', 'BATS'}
+ANALOG_FIELDS = ([k for k in INPUT_REGS if k not in ENUM_REGS] +
+                 [k for k in CALC_FIELDS if k not in BINARY_CALC_TYPES])
+AGGREGATES = ['AVG', 'MIN', 'MAX']
+
+def aggregate_fields(names):
+    return [f'{name}_{agg}' for name in names for agg in AGGREGATES]
+
+class WindowAccumulator:
+    # Statistics over a logging window.  The row itself keeps the last
+    # non-False value of each field, as the manufacturer's logs do; for
+    # discrete inputs this is the OR of all samples.  In addition, count,
+    # sum, minimum and maximum of the analog fields are kept in
+    # preallocated arrays, indexed in the order of ANALOG_FIELDS.
+    __slots__ = ('last', 'index', 'count', 'sum', 'min', 'max')
+
+    def __init__(self):
+        self.index = { name: i for i, name in enumerate(ANALOG_FIELDS) }
+        n = len(ANALOG_FIELDS)
+        self.count = array.array('L', itertools.repeat(0, n))
+        self.sum = array.array('d', itertools.repeat(0, n))
+        self.min = array.array('d', itertools.repeat(0, n))
+        self.max = array.array('d', itertools.repeat(0, n))
+        self.reset()
+
+    def reset(self):
+        self.last = {}
+        n = len(ANALOG_FIELDS)
+        self.count[:] = array.array('L', itertools.repeat(0, n))
+        self.sum[:] = array.array('d', itertools.repeat(0, n))
+        self.min[:] = array.array('d', itertools.repeat(math.inf, n))
+        self.max[:] = array.array('d', itertools.repeat(-math.inf, n))
+
+    def add(self, snapshot, values):
+        # snapshot has all the fields, values only those that were just read
+        for k, v in snapshot.items():
+            if v is not False:
+                self.last[k] = v
+
+        index = self.index
+        count, sum, min, max = self.count, self.sum, self.min, self.max
+        for k in itertools.chain(values, CALC_FIELDS):
+            i = index.get(k)
+            if i is None:
+                continue
+            v = snapshot[k]
+            count[i] += 1
+            sum[i] += v
+            if v < min[i]:
+                min[i] = v
+            if v > max[i]:
+                max[i] = v
+
+    def means(self):
+        return { k: self.sum[i] / self.count[i] for k, i in self.index.items() if self.count[i] }
+
+    def result(self, aggregates=()):
+        regs = dict(self.last)
+        for k in aggregates:
+            i = self.index[k]
+            if self.count[i]:
+                regs[k + '_AVG'] = self.sum[i] / self.count[i]
+                regs[k + '_MIN'] = self.min[i]
+                regs[k + '_MAX'] = self.max[i]
+        return regs
+
+class ModbusConnection:
+    # Keep the serial port open across polls.  An exception response
+    # fails only the block that was read, because the unit is answering.
+    # After a block times out even after retrying, the unit is considered
+    # dead: the port is closed and the unit is read again on a later poll,
+    # with exponential backoff between attempts.  The device is either a
+    # serial port or the HOST:PORT of a raw TCP server such as ser2net,
+    # which carries the RTU frames unchanged.  All units on a device share
+    # its connection, and the blocking reads run on a thread that belongs
+    # to the connection, so that requests to different units never overlap
+    # on the line; the backoff is per unit, so that a dead unit does not
+    # hold up the others.
+    def __init__(self, device='/dev/ttyUSB0', baudrate=2400, request_delay=1,
+                 retries=2, min_backoff=1, max_backoff=300):
+        if device.startswith('/'):
+            self.client = ModbusSerialClient('rtu', port=device, baudrate=baudrate)
+        else:
+            host, port = device.rsplit(':', maxsplit=1)
+            self.client = ModbusTcpClient(host, int(port), framer=ModbusRtuFramer)
+        self.device = device
+        self.baudrate = baudrate
+        self.request_delay = request_delay
+        self.last_request = 0
+        self.retries = retries
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.backoff = defaultdict(lambda: 0)
+        self.next_connect = defaultdict(lambda: 0)
+        self.connected = False
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    def connect(self, unit=1):
+        if time.monotonic() < self.next_connect[unit]:
+            return False
+        if self.connected:
+            return True
+        if not self.client.connect():
+            self.disconnect(unit)
+            return False
+        if self.backoff[unit]:
+            MODBUS_RECONNECTS.labels(self.device).inc()
+        self.connected = True
+        return True
+
+    def disconnect(self, unit=1):
+        self.client.close()
+        self.connected = False
+        self.backoff[unit] = min(self.max_backoff, max(self.min_backoff, self.backoff[unit] * 2))
+        self.next_connect[unit] = time.monotonic() + self.backoff[unit]
+
+    def close(self):
+        self.client.close()
+        self.connected = False
+
+    def _read(self, fn, address, count, unit, latency):
+        for attempt in range(self.retries + 1):
+            if not self.connect(unit):
+                return None
+            delay = self.last_request + self.request_delay - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            start = time.monotonic()
+            try:
+                rr = fn(address, count=count, unit=unit)
+            except ModbusException:
+                MODBUS_ERRORS.labels(self.device, 'connection').inc()
+                continue
+            finally:
+                self.last_request = time.monotonic()
+                latency.observe(self.last_request - start)
+            if not rr.isError():
+                self.backoff[unit] = 0
+                return rr
+            if not isinstance(rr, ModbusIOException):
+                MODBUS_ERRORS.labels(self.device, 'exception').inc()
+                self.backoff[unit] = 0
+                return None
+            MODBUS_ERRORS.labels(self.device, 'timeout').inc()
+
+        self.disconnect(unit)
+        return None
+
+    def read(self, block, unit=1):
+        latency = MODBUS_LATENCY.labels(self.device, f'{block.function} {block.start}+{block.count}')
+        return self._read(getattr(self.client, block.function), block.start, block.count, unit,
+                          latency)
+
+    def plan(self, input_regs=INPUT_REGS, discrete_inp=DISCRETE_INP):
+        return plan_reads(input_regs, discrete_inp,
+                          baudrate=self.baudrate, request_delay=self.request_delay)
+
+class Scheduler:
+    # Read each sampling class with its own plan and period.  The bus time
+    # that the medium and slow tiers leave free, up to the given utilization,
+    # goes to the fast tier; its period is only a lower bound.  If that is
+    # not enough to read it before the medium tier is due, the fast and
+    # medium tiers are slowed down together, and then all three, so that no
+    # tier is read more often than a faster one.  expire() removes the
+    # values that have not been read for STALE_PERIODS periods.
+    def __init__(self, conn, periods=TIER_PERIODS, utilization=0.5, unit=1):
+        self.conn = conn
+        self.unit = unit
+        self.periods = dict(periods)
+        self.plans = {}
+        for tier in periods:
+            input_regs = { k: v for k, v in INPUT_REGS.items() if v.tier == tier }
+            discrete_inp = { k: v for k, v in DISCRETE_INP.items() if v.tier == tier }
+            self.plans[tier] = conn.plan(input_regs, discrete_inp)
+
+        if utilization <= 0:
+            raise ValueError('bus utilization must be positive')
+        tiers = list(self.plans)
+        for n in range(1, len(tiers) + 1):
+            head, tail = tiers[:n], tiers[n:]
+            spare = utilization - sum(self.plans[tier].duration / self.periods[tier] for tier in tail)
+            if spare <= 0:
+                continue
+            period = sum(self.plans[tier].duration for tier in head) / spare
+            if not tail or period <= self.periods[tail[0]]:
+                break
+        for tier in head:
+            self.periods[tier] = max(self.periods[tier], period)
+        self.next_read = { tier: 0 for tier in self.plans }
+        self.fresh_until = {}
+        # units on the same device add up
+        BUS_UTILIZATION.labels(conn.device).inc(self.utilization)
+
+    @property
+    def utilization(self):
+        return sum(plan.duration / self.periods[tier] for tier, plan in self.plans.items())
+
+    def next_poll(self):
+        return min(self.next_read.values())
+
+    def poll(self):
+        now = time.monotonic()
+        values = {}
+        for tier, plan in self.plans.items():
+            if now < self.next_read[tier]:
+                continue
+            next_read = self.next_read[tier] + self.periods[tier]
+            self.next_read[tier] = next_read if next_read > now else now + self.periods[tier]
+            for block in plan.blocks:
+                rr = self.conn.read(block, self.unit)
+                if rr:
+                    decoded = block.decode(rr)
+                    values.update(decoded)
+                    fresh_until = time.monotonic() + STALE_PERIODS * self.periods[tier]
+                    self.fresh_until.update(dict.fromkeys(decoded, fresh_until))
+        return values
+
+    def expire(self, snapshot):
+        now = time.monotonic()
+        for k in [k for k, t in self.fresh_until.items() if t < now]:
+            del self.fresh_until[k]
+            snapshot.pop(k, None)
+
+    def describe(self):
+        for tier, plan in self.plans.items():
+            yield f'{tier} tier, every {self.periods[tier]:.1f} s:'
+            for line in plan.describe():
+                yield '  ' + line
+        yield f'bus utilization: {self.utilization:.1%}'
+
+def modbus_read(conn, plan, unit=1):
     snapshot = defaultdict(lambda: 0)
-    try:
-        c = ModbusSerialClient('rtu', port='/dev/ttyUSB0', baudrate=2400)
-        c.connect()
-        inregs = c.read_input_registers(0, count=MAX_REG+1, unit=1)
-        snapshot = { k: v(inregs) for k, v in INPUT_REGS.items() }
-        time.sleep(1)
-        di = c.read_discrete_inputs(0, count=MAX_DI+1, unit=1)
-        snapshot.update({ k: v(di) for k, v in DISCRETE_INP.items() })
-        c.close()
-    except ModbusException:
-        pass
+    for block in plan.blocks:
+        rr = conn.read(block, unit)
+        if rr:
+            snapshot.update(block.decode(rr))
 
     snapshot.update({ k: v(snapshot) for k, v in CALC_FIELDS.items() })
     return snapshot
 
+def derived_fields(regs):
+    discharge = charge = buy = sell = 0
+    if regs['BATS'] in [0, 4] and regs['BATA'] > 0:
+        mode = 'discharging'
+        discharge = -regs['XBT']
+    elif regs['PVW'] == 0:
+        mode = 'wait'
+    else:
+        charge = regs['XBT']
+        mode = 'charging' if regs['BATS'] == 3 or regs['BATV'] < 56 else 'day'
+
+    if regs['XGR'] < 0:
+        balance = 'sell'
+        sell = -regs['XGR']
+    else:
+        balance = 'buy'
+        buy = regs['XGR']
+
+    if regs['INVW'] < 0:
+        overhead = -regs['INVW']
+    elif discharge == 0:
+        overhead = regs['PVW'] + regs['XGR'] - regs['XHOME'] - charge
+    else:
+        overhead = regs['XHOME'] - discharge
+
+    return {
+        'mode': mode,
+        'balance': balance,
+        'home': regs['XHOME'],
+        'overhead': overhead,
+        'production': regs['PVW'],
+        'production/available': regs['PVW'] - charge if regs['PVW'] > 0 else 0,
+        'sell': sell,
+        'buy': buy,
+        'bat/charge': charge,
+        'bat/discharge': discharge,
+    }
+
+# Numeric values kept in the history, besides the analog fields
+DERIVED_FIELDS = ['home', 'overhead', 'production', 'production/available',
+                  'sell', 'buy', 'bat/charge', 'bat/discharge']
+
+class SnapshotHistory:
+    # Ring buffer of the most recent samples, with one preallocated array
+    # per field, for windowed queries that do not need to read the logs.
+    def __init__(self, capacity, fields=ANALOG_FIELDS + DERIVED_FIELDS):
+        self.capacity = capacity
+        self.times = array.array('d', itertools.repeat(0, capacity))
+        self.columns = { f: array.array('d', itertools.repeat(0, capacity)) for f in fields }
+        self.pos = 0
+        self.size = 0
+
+    def add(self, t, values):
+        pos = self.pos
+        self.times[pos] = t
+        for k, column in self.columns.items():
+            column[pos] = values.get(k, math.nan)
+        self.pos = (pos + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def query(self, field, window, now):
+        column = self.columns[field]
+        start = now - window
+        values = []
+        pos = self.pos
+        for i in range(self.size):
+            pos = (pos - 1) % self.capacity
+            if self.times[pos] < start:
+                break
+            if column[pos] == column[pos]:
+                values.append(column[pos])
+        if not values:
+            return { 'count': 0 }
+        return {
+            'count': len(values),
+            'mean': sum(values) / len(values),
+            'min': min(values),
+            'max': max(values),
+            'last': values[0],
+        }
+
+class PublishCache:
+    # Remember the last value sent to each topic, and suppress values that
+    # did not change or are within the deadband of the topic, unless the
+    # topic has been silent for more than max_silence seconds.  Deadbands
+    # are (absolute, relative) pairs indexed by the subtopic below the
+    # inverter's prefix, e.g. 'home' or 'energy/today/home'.
+    def __init__(self, deadbands={}, max_silence=300):
+        self.deadbands = deadbands
+        self.max_silence = max_silence
+        self.last = {}
+
+    def changed(self, topic, key, value, now):
+        last = self.last.get(topic)
+        if last is not None and now - last[1] < self.max_silence:
+            old = last[0]
+            if value == old:
+                return False
+            if key in self.deadbands and not isinstance(value, str) and not isinstance(old, str):
+                absolute, relative = self.deadbands[key]
+                if abs(value - old) <= max(absolute, relative * abs(old)):
+                    return False
+        self.last[topic] = (value, now)
+        return True
+
+    def clear(self):
+        self.last.clear()
+
 class MqttClient:
-    def __init__(self, server, client_id, topic):
+    def __init__(self, server, client_id, topic, deadbands={}, max_silence=300, json=False):
         self.mqtt_connected = False
         self.server = server
         self.topic = topic + '/'
+        self.json = json
+        self.cache = PublishCache(deadbands, max_silence)
+        self.query_handlers = {}
         self.client = paho.mqtt.client.Client(client_id=client_id)
 
         def on_connect(client, userdata, flags, rc):
             print("Connected to ." + self.server)
             self.mqtt_connected = True
+            self.cache.clear()
+            for topic in self.query_handlers:
+                self.client.subscribe(topic)
         self.client.on_connect = on_connect
 
+        def on_message(client, userdata, message):
+            if message.topic in self.query_handlers:
+                loop, handler = self.query_handlers[message.topic]
+                loop.call_soon_threadsafe(self.on_query, message, handler)
+        self.client.on_message = on_message
+
         def on_disconnect(client, userdata, rc):
             self.mqtt_connected = False
             if rc != 0:
@@ -262,87 +846,277 @@ class MqttClient:
         self.client.publish(self.topic + "connected", "0", retain=True)
         self.client.disconnect()
 
-    def publish(self, regs):
-         discharge = charge = buy = sell = 0
-         if regs['BATS'] in [0, 4] and regs['BATA'] > 0:
-             mode = 'discharging'
-             discharge = -regs['XBT']
-         elif regs['PVW'] == 0:
-             mode = 'wait'
-         else:
-             charge = regs['XBT']
-             mode = 'charging' if regs['BATS'] == 3 or regs['BATV'] < 56 else 'day'
-
-         if regs['XGR'] < 0:
-             balance = 'sell'
-             sell = -regs['XGR']
-         else:
-             balance = 'buy'
-             buy = regs['XGR']
-
-         if regs['INVW'] < 0:
-             overhead = -regs['INVW']
-         elif discharge == 0:
-             overhead = regs['PVW'] + regs['XGR'] - regs['XHOME'] - charge
-         else:
-             overhead = regs['XHOME'] - discharge
-
-         fields = {
-             'mode': mode,
-             'balance': balance,
-             'home': regs['XHOME'],
-             'overhead': overhead,
-             'production': regs['PVW'],
-             'production/available': regs['PVW'] - charge if regs['PVW'] > 0 else 0,
-             'sell': sell,
-             'buy': buy,
-             'bat/charge': charge,
-             'bat/discharge': discharge,
-         }
-         for k, v in fields.items():
-             self.client.publish(self.topic + k, format_field(v), retain=True)
+    def add_query_handler(self, prefix, loop, handler):
+        # Requests are JSON objects published to <topic>/query, and are
+        # answered on the topic given by their "reply" key; the handler
+        # runs in the event loop.
+        topic = self.topic + prefix + 'query'
+        self.query_handlers[topic] = (loop, handler)
+        self.client.subscribe(topic)
+
+    def on_query(self, message, handler):
+        try:
+            request = json.loads(message.payload)
+            reply = request.get('reply', message.topic + '/reply')
+        except (ValueError, AttributeError):
+            return
+        try:
+            response = handler(request)
+        except (KeyError, TypeError, ValueError) as e:
+            response = { 'error': str(e) }
+        if 'id' in request:
+            response['id'] = request['id']
+        self.client.publish(reply, json.dumps(response))
+
+    def publish(self, fields, prefix=''):
+        fields = { k: format_field(v) for k, v in fields.items() }
+        if self._publish_changed(prefix, fields) and self.json:
+            self.client.publish(self.topic + prefix + 'json', json.dumps(fields), retain=True)
+
+    def publish_energy(self, rollups, prefix=''):
+        self._publish_changed(prefix, { k: format_field(v) for k, v in rollups.daily.items() },
+                              'energy/today/')
+
+    def _publish_changed(self, prefix, fields, subtopic=''):
+        now = time.monotonic()
+        published = False
+        for k, v in fields.items():
+            topic = self.topic + prefix + subtopic + k
+            if self.cache.changed(topic, subtopic + k, v, now):
+                self.client.publish(topic, v, retain=True)
+                published = True
+        return published
+
+class Inverter:
+    # Each inverter is polled by its own task.  The blocking Modbus reads
+    # run on the thread of the inverter's device, so that a slow or dead
+    # device does not hold up the others.
+    def __init__(self, name, conn, scheduler, mqtt=None, binary=False, aggregates=(),
+                 history=3600, flush_interval=0, fsync=False, compactor=None):
+        self.name = name
+        self.conn = conn
+        self.scheduler = scheduler
+        self.mqtt = mqtt
+        self.prefix = name + '/' if name else ''
+        self.directory = name or '.'
+        self.aggregates = aggregates
+        fields = FIELDS + aggregate_fields(aggregates)
+        self.logs = [(CsvLogWriter(self.directory, fields, flush_interval=flush_interval, fsync=fsync,
+                                   compactor=compactor),
+                      LOG_WRITE.labels('csv'))]
+        if binary:
+            self.logs.append((binary_log_writer(self.directory, fields, flush_interval=flush_interval,
+                                                fsync=fsync),
+                              LOG_WRITE.labels('binary')))
+        self.rollups = EnergyRollups(self.directory)
+        self.history = SnapshotHistory(math.ceil(history / scheduler.periods[FAST]) + 1)
+
+    def query(self, request):
+        # {"field": "PVW", "window": 600} => {"count": ..., "mean": ..., ...}
+        field = request['field']
+        if field not in self.history.columns:
+            raise ValueError(f'unknown field {field}')
+        result = self.history.query(field, float(request.get('window', 60)), time.time())
+        return { 'field': field, **result }
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        os.makedirs(self.directory, exist_ok=True)
+        if self.mqtt:
+            self.mqtt.add_query_handler(self.prefix, loop, self.query)
+        window_stats = WindowAccumulator()
+        snapshot = defaultdict(lambda: 0)
+        window = None
+        try:
+            while True:
+                await asyncio.sleep(max(0, self.scheduler.next_poll() - time.monotonic()))
+                values = await loop.run_in_executor(self.conn.executor, self.scheduler.poll)
+                snapshot.update(values)
+                self.scheduler.expire(snapshot)
+                snapshot.update({ k: v(snapshot) for k, v in CALC_FIELDS.items() })
+                for k, v in DISCRETE_INP.items():
+                    if values.get(k) and v.alert:
+                        print(int(time.time()), self.prefix + v.alert)
+
+                fields = derived_fields(snapshot)
+                self.history.add(time.time(), { **snapshot, **fields })
+                if self.mqtt:
+                    with MQTT_PUBLISH.time():
+                        self.mqtt.publish(fields, self.prefix)
+
+                # write a row for each 5 minute window, once it is complete
+                # energy is computed from the averages over the window
+                if window is not None and snapshot['MOTD'] // 5 != window:
+                    regs = window_stats.result(self.aggregates)
+                    for log, write_time in self.logs:
+                        with write_time.time():
+                            log.write(regs)
+                    self.rollups.add({ **regs, **window_stats.means() })
+                    if self.mqtt:
+                        self.mqtt.publish_energy(self.rollups, self.prefix)
+                    window_stats.reset()
+                window = snapshot['MOTD'] // 5
+                window_stats.add(snapshot, values)
+        finally:
+            for log, write_time in self.logs:
+                log.close()
+
+def parse_inverter(spec, args):
+    # [NAME=]DEVICE[@UNIT][,OPTION=VALUE...]
+    spec, *options = spec.split(',')
+    name, _, device = spec.rpartition('=')
+    device, _, unit = device.partition('@')
+    settings = {
+        'baudrate': args.baudrate,
+        'request-delay': args.request_delay,
+        'fast-period': args.fast_period,
+    }
+    for option in options:
+        key, _, value = option.partition('=')
+        if key not in settings:
+            raise argparse.ArgumentTypeError(f'unknown inverter option {key}')
+        settings[key] = int(value) if key == 'baudrate' else float(value)
+    return name, device, int(unit or 1), settings
+
+def make_inverters(specs, args):
+    # Units on the same device share its connection and the bus time
+    # given by --bus-utilization
+    inverters = [parse_inverter(spec, args) for spec in specs]
+    names = [name for name, device, unit, settings in inverters]
+    if len(inverters) > 1 and (not all(names) or len(set(names)) < len(names)):
+        raise ValueError('inverters need unique names when there is more than one')
+
+    connections = {}
+    units = defaultdict(set)
+    for name, device, unit, settings in inverters:
+        if unit in units[device]:
+            raise ValueError(f'unit {unit} of {device} given more than once')
+        units[device].add(unit)
+        conn = connections.get(device)
+        if conn is None:
+            connections[device] = ModbusConnection(device, baudrate=settings['baudrate'],
+                                                   request_delay=settings['request-delay'])
+        elif (conn.baudrate, conn.request_delay) != (settings['baudrate'], settings['request-delay']):
+            raise ValueError(f'units of {device} have different baudrate or request-delay')
+
+    result = []
+    for name, device, unit, settings in inverters:
+        conn = connections[device]
+        scheduler = Scheduler(conn, { **TIER_PERIODS, FAST: settings['fast-period'] },
+                              utilization=args.bus_utilization / len(units[device]), unit=unit)
+        result.append((name, conn, scheduler))
+    return result
 
 def main():
     parser = argparse.ArgumentParser(description='Filesystem/MQTT logger for Ensolar2 hybrid inverters.')
     parser.add_argument('--query', action='store_true',
                         help='query inverter and exit')
+    parser.add_argument('--plan', action='store_true',
+                        help='print the Modbus requests issued for each poll and exit')
+    parser.add_argument('--inverter', metavar='[NAME=]DEVICE[@UNIT][,OPTION=VALUE...]',
+                        action='append', default=[],
+                        help='serial port or ser2net HOST:PORT of an inverter (can be repeated); '
+                             'baudrate, request-delay and fast-period can be set per inverter')
+    parser.add_argument('--baudrate', metavar='BPS', type=int, default=2400,
+                        help='Modbus line speed')
+    parser.add_argument('--request-delay', metavar='SECONDS', type=float, default=1,
+                        help='minimum delay between Modbus requests')
+    parser.add_argument('--fast-period', metavar='SECONDS', type=float, default=TIER_PERIODS[FAST],
+                        help='minimum period for power readings')
+    parser.add_argument('--bus-utilization', metavar='FRACTION', type=float, default=0.5,
+                        help='maximum fraction of time spent on the Modbus line')
     parser.add_argument('--mqtt', metavar='ADDRESS', help='MQTT server to connect to')
     parser.add_argument('--mqtt-topic', metavar='TOPIC', default='pv', help='MQTT base topic')
+    parser.add_argument('--mqtt-deadband', metavar='SUBTOPIC=ABSOLUTE[,RELATIVE]', action='append',
+                        default=[], help='do not publish changes smaller than ABSOLUTE or '
+                                         'RELATIVE times the last published value, for example home=20,0.05 or '
+                                         'energy/today/home=0.1 (can be repeated)')
+    parser.add_argument('--mqtt-max-silence', metavar='SECONDS', type=float, default=300,
+                        help='republish unchanged values after this time')
+    parser.add_argument('--mqtt-json', action='store_true',
+                        help='also publish all values as a single JSON object')
+    parser.add_argument('--history', metavar='SECONDS', type=float, default=3600,
+                        help='how much history to keep in memory for queries on <topic>/query')
     parser.add_argument('--output-directory', metavar='DIR', default='.', help='directory for CSV output')
+    parser.add_argument('--binary', action='store_true',
+                        help='also write a binary log (see ensolar2log.py)')
+    parser.add_argument('--aggregate', metavar='FIELD,...', default='',
+                        help='log average, minimum and maximum of these fields over each '
+                             'window ("all" for every analog field)')
+    parser.add_argument('--flush-interval', metavar='SECONDS', type=float, default=0,
+                        help='how often to flush the CSV output to disk (default: every row)')
+    parser.add_argument('--fsync', action='store_true',
+                        help='sync log files to disk when they are closed at midnight')
+    parser.add_argument('--compress', action='store_true',
+                        help='compress the CSV logs of past days (see ensolar2log.py)')
+    parser.add_argument('--metrics', metavar='[HOST:]PORT',
+                        help='serve Prometheus metrics over HTTP (default host: 127.0.0.1)')
     args = parser.parse_args()
 
+    aggregates = ANALOG_FIELDS if args.aggregate == 'all' else \
+        [f for f in args.aggregate.split(',') if f]
+    for f in aggregates:
+        if f not in ANALOG_FIELDS:
+            parser.error(f'cannot aggregate {f}')
+
+    # Named inverters log to a subdirectory and MQTT subtopic of their own
+    try:
+        inverters = make_inverters(args.inverter or ['/dev/ttyUSB0@1'], args)
+    except (ValueError, argparse.ArgumentTypeError) as e:
+        parser.error(str(e))
+
+    if args.plan:
+        for name, conn, scheduler in inverters:
+            if name:
+                print(f'{name}:')
+            for line in scheduler.describe():
+                print(line)
+        sys.exit(0)
+
+    deadbands = {}
+    for spec in args.mqtt_deadband:
+        key, _, values = spec.partition('=')
+        try:
+            absolute, _, relative = values.partition(',')
+            deadbands[key] = (float(absolute), float(relative or 0))
+        except ValueError:
+            parser.error(f'invalid deadband {spec}')
+
     os.chdir(args.output_directory)
+    mqtt = None
     if args.mqtt:
-        mqtt = MqttClient(args.mqtt, "pv", topic=args.mqtt_topic)
+        mqtt = MqttClient(args.mqtt, "pv", topic=args.mqtt_topic, deadbands=deadbands,
+                          max_silence=args.mqtt_max_silence, json=args.mqtt_json)
 
     if args.query:
-        snapshot = modbus_read()
-        out = format_fields(snapshot)
-        for k, v in zip(FIELDS, out):
-             print(k,v, sep='\t')
-        if args.mqtt:
-            mqtt.publish(snapshot)
+        for name, conn, scheduler in inverters:
+            snapshot = modbus_read(conn, conn.plan(), scheduler.unit)
+            out = format_fields(snapshot)
+            for k, v in zip(FIELDS, out):
+                 print(name + '/' + k if name else k, v, sep='\t')
+            if mqtt:
+                mqtt.publish(derived_fields(snapshot), name + '/' if name else '')
+        if mqtt:
             mqtt.disconnect()
         sys.exit(0)
 
-    if args.mqtt:
+    if mqtt:
         mqtt.will_set()
 
-    regs = {}
-    while True:
-        time.sleep(75-time.gmtime().tm_sec)
-        snapshot = modbus_read()
-        for k, v in DISCRETE_INP.items():
-            if snapshot[k] and v.alert:
-                print(int(time.time()), v.alert)
-
-        if args.mqtt:
-            mqtt.publish(snapshot)
-
-        merge_fields(regs, snapshot)
-        if (regs['MOTD'] % 5) == 4:
-            output_fields(regs)
-            regs = {}
+    # one thread compresses the logs of all inverters
+    compactor = Compactor() if args.compress else None
+
+    async def run():
+        if args.metrics:
+            await metrics.start_server(args.metrics)
+        await asyncio.gather(*(Inverter(name, conn, scheduler, mqtt,
+                                        binary=args.binary, aggregates=aggregates,
+                                        history=args.history,
+                                        flush_interval=args.flush_interval, fsync=args.fsync,
+                                        compactor=compactor).run()
+                               for name, conn, scheduler in inverters))
+
+    asyncio.run(run())
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,426 @@
+#! /usr/bin/env python3
+
+# Author: Paolo Bonzini
+# Licensed under AGPLv3.
+
+# Log files written by ensolar2.py.
+#
+# Besides the CSV files, ensolar2.py can write an append-only binary log
+# with fixed-width records.  A file starts with an 8-byte magic, the length
+# of a JSON header and the header itself, padded to a multiple of 8 bytes;
+# the header describes the record layout:
+#
+#   {"fields": [...all fields, in the same order as the CSV...],
+#    "columns": [{"name": "TS", "type": "q"},
+#                {"name": "BATV", "type": "h", "scale": 0.1},
+#                {"name": "BITS", "type": "Q", "bits": ["BT", "PV", ...]},
+#                ...],
+#    "constants": {"STATUS": 0, ...}}
+#
+# Registers are stored as raw 16-bit values and multiplied by the scale
+# when read, booleans are packed in a bitmask and fields that never change
+# are stored in the header only.  Records are little endian and unpadded.
+#
+# CSV logs of past days can be compressed (ensolar2.py --compress, or
+# ensolar2log.py --compact DIR).  YYYYMMDDVL.csv becomes YYYYMMDDVL.csv.gz,
+# made of one gzip member for the header and one for each hour, so that
+# zcat still gives back the original file.  YYYYMMDDVL.csv.gz.idx has the
+# position of each member:
+#
+#   {"header": [OFFSET, LENGTH],
+#    "blocks": [[HOUR, OFFSET, LENGTH, ROWS], ...]}
+#
+# where HOUR is the timestamp in seconds of the start of the hour.
+# csv_lines() reads plain and compressed logs alike, and only decompresses
+# the hours that it needs.
+
+import argparse
+import concurrent.futures
+import datetime
+import glob
+import gzip
+import json
+import os
+import struct
+import sys
+import time
+
+BINARY_MAGIC = b'ENS2LOG\n'
+HEADER_LENGTH = struct.Struct('<I')
+NUMPY_TYPES = {'q': '<i8', 'Q': '<u8', 'h': '<i2', 'f': '<f4'}
+COMPRESSED_SUFFIX = '.gz'
+INDEX_SUFFIX = '.idx'
+BLOCK_SECONDS = 3600
+
+
+class DailyLog:
+    # A log that is kept open and switches to a new file when a record's
+    # timestamp passes midnight.  If the day's file was written with a
+    # different header (e.g. after a restart with other fields), it is
+    # renamed to YYYYMMDD-N followed by the suffix, and a new one is started.
+    suffix = None
+    mode = 'a'
+
+    def __init__(self, directory='.', flush_interval=0, fsync=False, compactor=None):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.compactor = compactor
+        self.file = None
+        self.rotate_at = 0
+        self.last_flush = 0
+
+    def header(self):
+        return ''
+
+    def open(self, ts):
+        self.close()
+        tm = time.localtime(ts)
+        day = time.strftime('%Y%m%d', tm)
+        fname = os.path.join(self.directory, day + self.suffix)
+        header = self.header()
+        if os.path.exists(fname) and not self._has_header(fname, header):
+            os.rename(fname, self._free_name(day))
+        self.file = open(fname, self.mode)
+        if self.file.tell() == 0:
+            self.file.write(header)
+        self.rotate_at = time.mktime((tm.tm_year, tm.tm_mon, tm.tm_mday + 1, 0, 0, 0, 0, 0, -1))
+        if self.compactor:
+            self.compactor.submit(self.directory, day)
+
+    @staticmethod
+    def _has_header(fname, header):
+        if isinstance(header, str):
+            header = header.encode()
+        with open(fname, 'rb') as f:
+            data = f.read(len(header))
+        return not data or data == header
+
+    def _free_name(self, day):
+        n = 1
+        while True:
+            fname = os.path.join(self.directory, f'{day}-{n}{self.suffix}')
+            if not os.path.exists(fname) and not os.path.exists(fname + COMPRESSED_SUFFIX):
+                return fname
+            n += 1
+
+    def close(self):
+        if not self.file:
+            return
+        self.file.flush()
+        if self.fsync:
+            os.fsync(self.file.fileno())
+        self.file.close()
+        self.file = None
+
+    def append(self, ts, data):
+        if ts >= self.rotate_at:
+            self.open(ts)
+        self.file.write(data)
+        now = time.monotonic()
+        if now - self.last_flush >= self.flush_interval:
+            self.file.flush()
+            self.last_flush = now
+
+
+class BinaryLogWriter(DailyLog):
+    suffix = 'VL.bin'
+    mode = 'ab'
+
+    def __init__(self, fields, columns, constants, directory='.', **kwargs):
+        super().__init__(directory, **kwargs)
+        self.schema = {'fields': fields, 'columns': columns, 'constants': constants}
+        self.record = struct.Struct('<' + ''.join(c['type'] for c in columns))
+        self.encoders = [self._encoder(c) for c in columns]
+
+    @staticmethod
+    def _encoder(column):
+        name = column['name']
+        if 'bits' in column:
+            bits = [(1 << i, name) for i, name in enumerate(column['bits'])]
+            return lambda regs: sum(bit for bit, name in bits if regs.get(name))
+        if column.get('scale') is not None:
+            scale = column['scale']
+            return lambda regs: round(regs.get(name, 0) / scale)
+        if column['type'] == 'f':
+            return lambda regs: float(regs.get(name, 0))
+        return lambda regs: int(regs.get(name, 0))
+
+    def header(self):
+        header = json.dumps(self.schema).encode()
+        length = len(BINARY_MAGIC) + HEADER_LENGTH.size + len(header)
+        header += b' ' * (-length % 8)
+        return BINARY_MAGIC + HEADER_LENGTH.pack(len(header)) + header
+
+    def write(self, regs):
+        self.append(regs['TS'] / 1000, self.record.pack(*[f(regs) for f in self.encoders]))
+
+
+def read_header(f):
+    if f.read(len(BINARY_MAGIC)) != BINARY_MAGIC:
+        raise ValueError(f'{f.name}: not an ensolar2 binary log')
+    length, = HEADER_LENGTH.unpack(f.read(HEADER_LENGTH.size))
+    schema = json.loads(f.read(length))
+    return schema, len(BINARY_MAGIC) + HEADER_LENGTH.size + length
+
+
+def log_files(directory='.', suffix='VL.bin', start=None, end=None):
+    # Daily files in a directory, optionally limited to the days between
+    # start and end (inclusive, as YYYYMMDD strings).  Files that DailyLog
+    # renamed because of a different header sort before the day's file.
+    files = sorted(glob.glob(os.path.join(directory, '[0-9]' * 8 + suffix)) +
+                   glob.glob(os.path.join(directory, '[0-9]' * 8 + '-*' + suffix)))
+    return [f for f in files
+            if (start is None or os.path.basename(f)[:8] >= start) and
+               (end is None or os.path.basename(f)[:8] <= end)]
+
+
+def csv_log_files(directory='.', start=None, end=None):
+    # Same as log_files, for plain and compressed CSV logs.  The plain
+    # file wins if there are both, because it is only removed once the
+    # compressed one is complete.
+    files = {}
+    for path in (log_files(directory, 'VL.csv' + COMPRESSED_SUFFIX, start, end) +
+                 log_files(directory, 'VL.csv', start, end)):
+        files[os.path.basename(path).split('.')[0]] = path
+    return [files[name] for name in sorted(files)]
+
+
+def daily_log_files(directory='.', start=None, end=None):
+    # One log for each day: with ensolar2.py --binary there is both a CSV
+    # and a binary log, and the binary one is faster to read
+    files = {}
+    for path in csv_log_files(directory, start, end) + log_files(directory, 'VL.bin', start, end):
+        files[os.path.basename(path).split('.')[0]] = path
+    return [files[name] for name in sorted(files)]
+
+
+def timestamp(value):
+    # YYYY-MM-DD[THH:MM[:SS]] in local time, for command line arguments
+    return datetime.datetime.fromisoformat(value).timestamp()
+
+
+def day_range(start=None, end=None):
+    # First and last day for log_files of the time range [start, end)
+    day = lambda ts: time.strftime('%Y%m%d', time.localtime(ts))
+    return (None if start is None else day(start),
+            None if end is None else day(end - 0.001))
+
+
+def _csv_timestamp(line, column):
+    # TS of a CSV row in seconds, or None if the line is damaged
+    try:
+        return float(line.split(',', column + 1)[column]) / 1000
+    except (IndexError, ValueError):
+        return None
+
+
+def _filter_rows(lines, column, start, end):
+    if start is None and end is None:
+        yield from lines
+        return
+    for line in lines:
+        ts = _csv_timestamp(line, column)
+        if ts is not None and (start is None or ts >= start) and (end is None or ts < end):
+            yield line
+
+
+def read_index(path):
+    # Index of a compressed CSV log, or None if it is missing or does not
+    # match the file
+    try:
+        with open(path + INDEX_SUFFIX) as f:
+            index = json.load(f)
+        offset, length = index['blocks'][-1][1:3] if index['blocks'] else index['header']
+        if offset + length != os.path.getsize(path):
+            return None
+    except (OSError, ValueError, KeyError, IndexError):
+        return None
+    return index
+
+
+def csv_lines(path, start=None, end=None):
+    # Lines of a plain or compressed CSV log: the header, then the rows
+    # with start <= TS < end (in seconds, None for no limit)
+    index = read_index(path) if path.endswith(COMPRESSED_SUFFIX) else None
+    if index is None:
+        with (gzip.open if path.endswith(COMPRESSED_SUFFIX) else open)(path, 'rt') as f:
+            header = f.readline()
+            yield header
+            yield from _filter_rows(f, header.rstrip('\n').split(',').index('TS'), start, end)
+        return
+
+    with open(path, 'rb') as f:
+        offset, length = index['header']
+        f.seek(offset)
+        header = gzip.decompress(f.read(length)).decode()
+        yield header
+        column = header.rstrip('\n').split(',').index('TS')
+        for hour, offset, length, rows in index['blocks']:
+            if hour is not None and ((start is not None and hour + BLOCK_SECONDS <= start) or
+                                     (end is not None and hour >= end)):
+                continue
+            f.seek(offset)
+            lines = gzip.decompress(f.read(length)).decode().splitlines(keepends=True)
+            yield from _filter_rows(lines, column, start, end)
+
+
+def compact_csv(path, level=9):
+    # Compress a CSV log and remove it, see the top of the file
+    compressed = path + COMPRESSED_SUFFIX
+    with open(path, 'rb') as f:
+        data = f.read()
+    if os.path.exists(compressed):
+        # Either a previous run stopped before removing the CSV, or the
+        # day was written to again (e.g. the clock went back); in the
+        # latter case add the new rows
+        with gzip.open(compressed, 'rb') as f:
+            old = f.read()
+        if old != data:
+            if old[:old.find(b'\n')] != data[:data.find(b'\n')]:
+                raise ValueError(f'{compressed} has a different header')
+            if not old.endswith(b'\n'):
+                old += b'\n'
+            data = old + data[data.find(b'\n') + 1:]
+    lines = data.splitlines(keepends=True)
+    if not lines:
+        os.unlink(path)
+        return
+    column = lines[0].decode().rstrip('\n').split(',').index('TS')
+
+    # Damaged lines, including a partial line left over from a crash,
+    # stay in the current block
+    blocks = []
+    for line in lines[1:]:
+        ts = _csv_timestamp(line.decode(errors='replace'), column) if line.endswith(b'\n') else None
+        hour = None if ts is None else int(ts // BLOCK_SECONDS * BLOCK_SECONDS)
+        if not blocks or (hour is not None and blocks[-1][0] not in (None, hour)):
+            blocks.append([hour, []])
+        elif hour is not None:
+            blocks[-1][0] = hour
+        blocks[-1][1].append(line)
+
+    with open(compressed + '.tmp', 'wb') as f:
+        member = gzip.compress(lines[0], compresslevel=level, mtime=0)
+        f.write(member)
+        index = {'header': [0, len(member)], 'blocks': []}
+        for hour, block in blocks:
+            offset = f.tell()
+            f.write(gzip.compress(b''.join(block), compresslevel=level, mtime=0))
+            index['blocks'].append([hour, offset, f.tell() - offset, len(block)])
+        f.flush()
+        os.fsync(f.fileno())
+    with open(compressed + '.tmp', 'rb') as f:
+        if gzip.decompress(f.read()) != data:
+            os.unlink(compressed + '.tmp')
+            raise ValueError('compressed data does not match')
+    with open(compressed + INDEX_SUFFIX + '.tmp', 'w') as f:
+        json.dump(index, f)
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.replace(compressed + '.tmp', compressed)
+    os.replace(compressed + INDEX_SUFFIX + '.tmp', compressed + INDEX_SUFFIX)
+    os.unlink(path)
+
+
+def compact_directory(directory='.', before=None):
+    # Compress the CSV logs of the days before the given one (YYYYMMDD,
+    # default today)
+    before = before or time.strftime('%Y%m%d')
+    for path in log_files(directory, 'VL.csv'):
+        if os.path.basename(path)[:8] >= before:
+            continue
+        try:
+            compact_csv(path)
+        except (OSError, ValueError) as e:
+            print(f'{path}: {e}', file=sys.stderr)
+
+
+class Compactor:
+    # Compresses the CSV logs of finished days on a background thread;
+    # DailyLog submits its directory whenever it opens a new file.
+    def __init__(self):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    def submit(self, directory, day):
+        return self.executor.submit(compact_directory, directory, day)
+
+
+def read_binary(paths, scaled=True):
+    # Memory-map binary logs and return a dictionary of NumPy columns.
+    # With a single file the register columns are views on the mapping;
+    # multiple files are concatenated.
+    import numpy
+
+    if isinstance(paths, str):
+        paths = [paths]
+
+    days = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            schema, offset = read_header(f)
+        dtype = numpy.dtype([(c['name'], NUMPY_TYPES[c['type']]) for c in schema['columns']])
+        # a partial record at the end is left over from a crash
+        n = (os.path.getsize(path) - offset) // dtype.itemsize
+        if n == 0:
+            continue
+        rec = numpy.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(n,))
+
+        day = {}
+        for c in schema['columns']:
+            col = rec[c['name']]
+            if 'bits' in c:
+                for i, name in enumerate(c['bits']):
+                    day[name] = (col >> numpy.uint64(i)) & numpy.uint64(1) != 0
+            elif scaled and c.get('scale') is not None:
+                day[c['name']] = col * c['scale']
+            else:
+                day[c['name']] = col
+        for name, value in schema['constants'].items():
+            day[name] = numpy.full(n, value)
+        days.append((n, day))
+
+    if len(days) == 1:
+        return days[0][1]
+
+    # columns missing from some of the files are filled with NaNs
+    names = list(dict.fromkeys(name for n, day in days for name in day))
+    return {name: numpy.concatenate([day.get(name, numpy.full(n, numpy.nan)) for n, day in days])
+            for name in names}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Dump ensolar2 logs as CSV, or compress CSV logs.')
+    parser.add_argument('--start', metavar='YYYY-MM-DD[THH:MM]', type=timestamp,
+                        help='only dump rows from this time')
+    parser.add_argument('--end', metavar='YYYY-MM-DD[THH:MM]', type=timestamp,
+                        help='only dump rows before this time')
+    parser.add_argument('--compact', action='store_true',
+                        help='compress the CSV logs of past days in the given directories')
+    parser.add_argument('files', metavar='FILE', nargs='+',
+                        help='binary or CSV (possibly compressed) log files')
+    args = parser.parse_args()
+
+    if args.compact:
+        for directory in args.files:
+            compact_directory(directory)
+        return
+
+    for path in args.files:
+        if not path.endswith('.bin'):
+            sys.stdout.writelines(csv_lines(path, args.start, args.end))
+            continue
+        with open(path, 'rb') as f:
+            schema, offset = read_header(f)
+        columns = read_binary(path)
+        fields = [f for f in schema['fields'] if f in columns]
+        print(','.join(fields))
+        for row in zip(*(columns[f].tolist() for f in fields)):
+            ts = row[fields.index('TS')] / 1000
+            if (args.start is not None and ts < args.start) or (args.end is not None and ts >= args.end):
+                continue
+            print(','.join(str(round(v, 2) if isinstance(v, float) else int(v)) for v in row))
+
+if __name__ == '__main__':
+    main()
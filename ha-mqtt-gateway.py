@@ -7,22 +7,116 @@
 # - the full state is exposed to MQTT as a retained message
 # - services can be invoked by publishing to the MQTT topic
 #   ha-mqtt-gateway/ENTITY_ID/DOMAIN.SERVICE (payload is
-#   passed as data)
+#   passed as data); the result is published to
+#   ha-mqtt-gateway/ENTITY_ID/DOMAIN.SERVICE/result
+# - selected attributes are published separately to
+#   ha-mqtt-gateway/ENTITY_ID/attributes/NAME when they change
+# - the time each service call spent queued in the gateway, waiting for
+#   the result and waiting for the entity's state to change is published
+#   to ha-mqtt-gateway/ENTITY_ID/DOMAIN.SERVICE/trace, and percentiles
+#   to ha-mqtt-gateway/diagnostics/commands
 
 import argparse
 import asyncio
+import collections
+import datetime
+import fnmatch
 import ijson
 import json
+import metrics
 import paho.mqtt.client
+import re
 import sys
+import threading
+import time
 import urllib.parse
 import websockets
 
+FRAME_SIZE = metrics.Histogram('ha_mqtt_gateway_websocket_frame_bytes',
+                               'size of websocket frames from Home Assistant',
+                               buckets=metrics.SIZE_BUCKETS)
+PARSE_TIME = metrics.Histogram('ha_mqtt_gateway_parse_seconds',
+                               'time to parse a websocket frame, including the callbacks it triggers')
+EVENT_LATENCY = metrics.Histogram('ha_mqtt_gateway_event_latency_seconds',
+                                  'time from a state change in Home Assistant to MQTT')
+PENDING_COMMANDS = metrics.Gauge('ha_mqtt_gateway_pending_commands',
+                                 'commands waiting for a result from Home Assistant')
+COMMAND_LATENCY = metrics.Histogram('ha_mqtt_gateway_command_seconds',
+                                    'time from a service call on MQTT to each stage', ['stage'])
+RECONNECTS = metrics.Counter('ha_mqtt_gateway_reconnects_total',
+                             'connections reestablished after they were lost', ['service'])
+MQTT_FLUSH = metrics.Histogram('ha_mqtt_gateway_mqtt_flush_seconds',
+                               'time to pass a batch of messages to the MQTT client')
+MQTT_QUEUE = metrics.Gauge('ha_mqtt_gateway_mqtt_queue', 'topics waiting to be sent to MQTT')
+MQTT_DROPPED = metrics.Counter('ha_mqtt_gateway_mqtt_dropped_total',
+                               'messages dropped because the MQTT queue was full')
+
 
 class AuthInvalidError(Exception):
     pass
 
 
+class EntityFilter:
+    # Include/exclude rules for entity ids.  A rule is a domain ("light"),
+    # a glob ("sensor.*_power") or a regular expression matching the whole
+    # entity id ("re:switch\.presa_[0-9]+").  With no include rules, all
+    # entities that are not excluded pass the filter.
+    def __init__(self, include=[], exclude=[]):
+        self.include = self._compile(include) if include else None
+        self.exclude = self._compile(exclude)
+        self.cache = dict()
+
+    @staticmethod
+    def _compile(rules):
+        domains = set()
+        patterns = []
+        for rule in rules:
+            if rule.startswith('re:'):
+                patterns.append(f'(?:{rule[3:]})\\Z')
+            elif '.' in rule or any(c in rule for c in '*?['):
+                patterns.append(fnmatch.translate(rule))
+            else:
+                domains.add(rule)
+        return domains, re.compile('|'.join(patterns)) if patterns else None
+
+    @staticmethod
+    def _match(rules, entity_id):
+        domains, regex = rules
+        return (entity_id.split('.', maxsplit=1)[0] in domains or
+                bool(regex and regex.match(entity_id)))
+
+    def __call__(self, entity_id):
+        try:
+            return self.cache[entity_id]
+        except KeyError:
+            pass
+        result = ((self.include is None or self._match(self.include, entity_id)) and
+                  not self._match(self.exclude, entity_id))
+        self.cache[entity_id] = result
+        return result
+
+
+class AttributeSelector:
+    # Attributes to publish for each entity, from ENTITY_GLOB=NAME,... specs.
+    # The lists of all matching specs are merged.
+    def __init__(self, specs=[]):
+        self.rules = []
+        for spec in specs:
+            pattern, _, names = spec.partition('=')
+            self.rules.append((re.compile(fnmatch.translate(pattern)), names.split(',')))
+        self.cache = dict()
+
+    def __call__(self, entity_id):
+        try:
+            return self.cache[entity_id]
+        except KeyError:
+            pass
+        result = list(dict.fromkeys(name for regex, names in self.rules
+                                    if regex.match(entity_id) for name in names))
+        self.cache[entity_id] = result
+        return result
+
+
 class HASSWebsockets:
     CONNECTED = 0
     AUTH_REQUIRED = 1
@@ -39,10 +133,14 @@ class HASSWebsockets:
 
         self.on_auth_ok = lambda: None
         self.on_event = lambda obj: None
+        self.on_command = lambda msg: None
+        self.on_result = lambda obj: None
+        self.event_filter = None
         self.id = 1
         self.connection = None
 
         self.futures = dict()
+        self.item_callbacks = dict()
         self.ready = asyncio.Event()
 
     async def _send(self, msg):
@@ -57,8 +155,11 @@ class HASSWebsockets:
             cmd_id, f = next(iter(self.futures.items()))
             del self.futures[cmd_id]
             f.cancel()
+        self.item_callbacks.clear()
 
-    async def send_cmd(self, msg):
+    async def send_cmd(self, msg, on_item=None):
+        # If on_item is given, each item of the result list is passed to
+        # it as soon as it has been parsed, and not included in the result
         await self.ready.wait()
         if self.auth_invalid:
             obj = self.auth_invalid
@@ -70,8 +171,15 @@ class HASSWebsockets:
 
         f = asyncio.Future()
         self.futures[cmd_id] = f
-        await self._send(msg)
-        await f
+        if on_item:
+            self.item_callbacks[cmd_id] = on_item
+        self.on_command(msg)
+        try:
+            await self._send(msg)
+            await f
+        finally:
+            self.futures.pop(cmd_id, None)
+            self.item_callbacks.pop(cmd_id, None)
         return f.result()
 
     async def _subscribe_events(self):
@@ -107,15 +215,49 @@ class HASSWebsockets:
             assert obj["type"] == "event" or obj["type"] == "result"
             if obj["type"] == "event":
                 self.on_event(obj)
-            elif obj["id"] in self.futures:
-                f = self.futures[obj["id"]]
-                del self.futures[obj["id"]]
-                f.set_result(obj)
-
-    def _process_messages(self):
+            else:
+                self.on_result(obj)
+                if obj["id"] in self.futures:
+                    f = self.futures[obj["id"]]
+                    del self.futures[obj["id"]]
+                    f.set_result(obj)
+
+    def _process_events(self):
+        # Build each message from the ijson events.  HA sends the id first,
+        # so the items of a command's result can be streamed to its
+        # callback instead of materializing the whole list.  Likewise,
+        # events for entities rejected by event_filter are skipped as soon
+        # as the entity id is seen, without building the states.
         while True:
-            obj = yield
-            self._process_message(obj)
+            builder = ijson.ObjectBuilder()
+            on_item = None
+            skip = False
+            while True:
+                prefix, event, value = yield
+                if skip:
+                    if prefix == '' and event == 'end_map':
+                        break
+                    continue
+                if prefix == 'id' and event == 'number':
+                    on_item = self.item_callbacks.get(value)
+                elif prefix == 'event.data.entity_id' and event == 'string':
+                    skip = self.event_filter is not None and not self.event_filter(value)
+                elif prefix == 'result.item' and event == 'start_map' and on_item:
+                    item = ijson.ObjectBuilder()
+                    while True:
+                        item.event(event, value)
+                        if prefix == 'result.item' and event == 'end_map':
+                            break
+                        prefix, event, value = yield
+                    on_item(item.value)
+                    continue
+
+                builder.event(event, value)
+                if prefix == '' and event == 'end_map':
+                    break
+
+            if not skip:
+                self._process_message(builder.value)
 
     async def _run_once(self, websocket):
         self.auth_invalid = None
@@ -123,21 +265,17 @@ class HASSWebsockets:
         self.connection = websocket
         self.state = self.CONNECTED
 
-        ijson_gen = self._process_messages()
+        ijson_gen = self._process_events()
         ijson_gen.send(None)
-        ijson_coro = ijson.items_coro(ijson_gen, '', use_float=True, multiple_values=True)
+        ijson_coro = ijson.parse_coro(ijson_gen, use_float=True, multiple_values=True)
 
         try:
             while True:
-                data = await websocket.recv()
-                if not data:
-                    break
-                # it's quite silly to have to re-encode str into bytes,
-                # but websockets decodes TEXT frames and there's nothing
-                # you can do about it.
-                if isinstance(data, str):
-                    data = data.encode(encoding='utf-8')
-                ijson_coro.send(data)
+                # feed the raw frames to ijson, without decoding TEXT frames
+                async for data in websocket.recv_streaming(decode=False):
+                    FRAME_SIZE.observe(len(data))
+                    with PARSE_TIME.time():
+                        ijson_coro.send(data)
 
                 if self.auth_invalid:
                     obj = self.auth_invalid
@@ -148,6 +286,9 @@ class HASSWebsockets:
 
         finally:
             print("hass closing")
+            # commands sent from now on wait for the next connection
+            if not self.auth_invalid:
+                self.ready.clear()
             self.cancel_all_commands()
             self.connection = None
             ijson_coro.close()
@@ -155,8 +296,12 @@ class HASSWebsockets:
             await websocket.wait_closed()
 
     async def run(self):
+        connections = 0
         try:
-            async for websocket in websockets.connect(self.address):
+            async for websocket in websockets.connect(self.address, max_size=None):
+                if connections:
+                    RECONNECTS.labels('hass').inc()
+                connections += 1
                 try:
                     await self._run_once(websocket)
                 except websockets.exceptions.ConnectionClosed:
@@ -165,24 +310,370 @@ class HASSWebsockets:
             pass
 
 
+class ServiceDispatcher:
+    # Forwards service calls with at most max_inflight of them in flight
+    # and at most rate calls per second (0 for no limit).  A call that is
+    # still queued is replaced by a newer one for the same entity and
+    # service, and calls for an entity and service that is already in
+    # flight wait for it to complete.  on_dispatch is called with the key
+    # of each call when it leaves the queue.
+    def __init__(self, call, on_result, max_inflight=4, rate=10):
+        self.call = call
+        self.on_result = on_result
+        self.on_dispatch = lambda key: None
+        self.max_inflight = max_inflight
+        self.rate = rate
+        self.tokens = max(rate, 1)
+        self.last_refill = None
+        self.pending = collections.OrderedDict()
+        self.inflight = set()
+        self.wakeup = asyncio.Event()
+
+    def submit(self, entity, domain, service, data):
+        self.pending[(entity, domain, service)] = data
+        self.wakeup.set()
+
+    def _next(self):
+        for key in self.pending:
+            if key not in self.inflight:
+                return key
+        return None
+
+    async def _throttle(self):
+        if not self.rate:
+            return
+        now = asyncio.get_running_loop().time()
+        if self.last_refill is not None:
+            self.tokens = min(max(self.rate, 1), self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+        if self.tokens < 1:
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+            self.tokens = 1
+            self.last_refill = asyncio.get_running_loop().time()
+        self.tokens -= 1
+
+    async def _dispatch(self, key, data):
+        entity, domain, service = key
+        try:
+            obj = await self.call(domain, service, {"entity_id": entity}, data)
+            result = {"success": obj["success"]}
+            if "error" in obj:
+                result["error"] = obj["error"]
+        except asyncio.CancelledError:
+            result = {"success": False, "error": {"code": "cancelled",
+                                                  "message": "Home Assistant disconnected"}}
+        except AuthInvalidError as e:
+            result = {"success": False, "error": {"code": "auth_invalid", "message": str(e)}}
+        except Exception as e:
+            result = {"success": False, "error": {"code": "error", "message": str(e)}}
+        finally:
+            self.inflight.discard(key)
+            self.wakeup.set()
+        self.on_result(key, result)
+
+    async def run(self):
+        while True:
+            key = self._next()
+            if key is None or len(self.inflight) >= self.max_inflight:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+
+            await self._throttle()
+            # the call may have been replaced in the meanwhile
+            key = self._next()
+            data = self.pending.pop(key)
+            self.inflight.add(key)
+            self.on_dispatch(key)
+            asyncio.create_task(self._dispatch(key, data))
+
+
+class CommandTracer:
+    # Follows service calls from the MQTT message to the result from
+    # Home Assistant and to the first state change of the target entity.
+    # Each call is split in three stages:
+    # - queued: from the MQTT message to the websocket send (dispatcher
+    #   queue, rate limit and event loop)
+    # - result: from the websocket send to the result message
+    # - state: from the websocket send to the first state change
+    # A slow state with a fast result points at the device (for example
+    # the Zigbee network) rather than at Home Assistant.
+    #
+    # on_trace is called with the key and the stages of each call, once
+    # both the result and the state change arrived or after timeout
+    # seconds.  The last window samples of each stage are kept for
+    # summary().
+    STAGES = ("queued", "result", "state")
+
+    def __init__(self, on_trace, window=200, timeout=30):
+        self.on_trace = on_trace
+        self.timeout = timeout
+        self.received = dict()
+        self.dispatched = dict()
+        self.commands = dict()
+        self.waiting = collections.defaultdict(list)
+        self.samples = {stage: collections.deque(maxlen=window) for stage in self.STAGES}
+        self.timeouts = 0
+        self.changed = False
+
+    def on_message(self, key):
+        # a call that replaces a queued one keeps its arrival time
+        self.received.setdefault(key, time.monotonic())
+
+    def on_dispatch(self, key):
+        # the call left the queue, so a new message starts a new call
+        if key in self.received:
+            self.dispatched[key] = self.received.pop(key)
+
+    def on_done(self, key):
+        # forget calls that failed before they were sent
+        self.dispatched.pop(key, None)
+
+    def on_command(self, msg):
+        if msg["type"] != "call_service":
+            return
+        key = (msg["target"]["entity_id"], msg["domain"], msg["service"])
+        received = self.dispatched.pop(key, None)
+        if received is None:
+            return
+        now = time.monotonic()
+        trace = {"key": key, "sent": now, "queued": now - received}
+        self._observe("queued", trace["queued"])
+        self.commands[msg["id"]] = trace
+        self.waiting[key[0]].append(trace)
+
+    def on_result(self, obj):
+        trace = self.commands.pop(obj["id"], None)
+        if trace is None:
+            return
+        trace["result"] = time.monotonic() - trace["sent"]
+        self._observe("result", trace["result"])
+        self._complete(trace)
+
+    def on_state(self, entity_id):
+        traces = self.waiting.pop(entity_id, None)
+        if traces is None:
+            return
+        now = time.monotonic()
+        for trace in traces:
+            trace["state"] = now - trace["sent"]
+            self._observe("state", trace["state"])
+            self._complete(trace)
+
+    def _observe(self, stage, value):
+        COMMAND_LATENCY.labels(stage).observe(value)
+        self.samples[stage].append(value)
+        self.changed = True
+
+    def _complete(self, trace):
+        if "result" in trace and "state" in trace:
+            self.on_trace(trace["key"], {stage: trace[stage] for stage in self.STAGES})
+
+    def expire(self):
+        # Report calls that did not get a result or did not change the state.
+        # A call is in commands until its result arrives, and in waiting
+        # until its state changes, so it may have expired in either or both
+        deadline = time.monotonic() - self.timeout
+        expired = dict()
+        for cmd_id, trace in list(self.commands.items()):
+            if trace["sent"] < deadline:
+                del self.commands[cmd_id]
+                expired[id(trace)] = trace
+        for entity_id, traces in list(self.waiting.items()):
+            for trace in traces:
+                if trace["sent"] < deadline:
+                    expired[id(trace)] = trace
+            traces = [trace for trace in traces if trace["sent"] >= deadline]
+            if traces:
+                self.waiting[entity_id] = traces
+            else:
+                del self.waiting[entity_id]
+        if not expired:
+            return
+        self.timeouts += len(expired)
+        self.changed = True
+        for trace in expired.values():
+            self.on_trace(trace["key"], {stage: trace.get(stage) for stage in self.STAGES})
+
+    def summary(self):
+        # Percentiles of each stage, in seconds
+        result = {"timeouts": self.timeouts}
+        for stage, samples in self.samples.items():
+            values = sorted(samples)
+            if not values:
+                continue
+            result[stage] = {f"p{p}": values[len(values) * p // 100] for p in (50, 90, 99)}
+            result[stage]["max"] = values[-1]
+            result[stage]["count"] = len(values)
+        self.changed = False
+        return result
+
+
+class AsyncioMQTT:
+    # Drives a paho client from the asyncio event loop instead of paho's
+    # own thread, so that its callbacks run on the event loop.
+    #
+    # Messages are queued and passed to paho in batches, only once it has
+    # written out the previous batch.  If the broker is slow, messages
+    # for the same topic replace each other in the queue, and the oldest
+    # ones are dropped once max_queue topics are waiting; on_drop is called
+    # with the topic of each dropped message.
+    def __init__(self, client, loop, max_queue=10000, batch=100):
+        self.client = client
+        self.loop = loop
+        self.max_queue = max_queue
+        self.batch = batch
+        self.queue = collections.OrderedDict()
+        MQTT_QUEUE.set_function(lambda: len(self.queue))
+        self.flush_scheduled = False
+        self.stopping = False
+        self.closed = asyncio.Event()
+        self.closed.set()
+        self.on_drop = lambda topic: None
+
+        # reconnect() runs on another thread, see run()
+        self.loop_thread = None
+        client.on_socket_open = lambda *args: self._in_loop(self.on_socket_open, *args)
+        client.on_socket_close = lambda *args: self._in_loop(self.on_socket_close, *args)
+        client.on_socket_register_write = \
+            lambda *args: self._in_loop(self.on_socket_register_write, *args)
+        client.on_socket_unregister_write = \
+            lambda *args: self._in_loop(self.on_socket_unregister_write, *args)
+
+    def _in_loop(self, function, *args):
+        if threading.get_ident() == self.loop_thread:
+            function(*args)
+        else:
+            self.loop.call_soon_threadsafe(function, *args)
+
+    def on_socket_open(self, client, userdata, sock):
+        self.closed.clear()
+        self.loop.add_reader(sock, client.loop_read)
+
+    def on_socket_close(self, client, userdata, sock):
+        self.loop.remove_reader(sock)
+        self.closed.set()
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self.loop.add_writer(sock, client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.loop.remove_writer(sock)
+        self.schedule_flush()
+
+    def publish(self, topic, payload, retain=False):
+        self.queue[topic] = (payload, retain)
+        if len(self.queue) > self.max_queue:
+            topic, _ = self.queue.popitem(last=False)
+            MQTT_DROPPED.inc()
+            self.on_drop(topic)
+        self.schedule_flush()
+
+    def schedule_flush(self):
+        if self.queue and not self.flush_scheduled:
+            self.flush_scheduled = True
+            self.loop.call_soon(self.flush)
+
+    def flush(self, limit=None):
+        self.flush_scheduled = False
+        if not self.client.is_connected():
+            return
+        if limit is None:
+            # wait until paho has written the previous batch
+            if self.client.want_write():
+                return
+            limit = self.batch
+        with MQTT_FLUSH.time():
+            for i in range(min(limit, len(self.queue))):
+                topic, (payload, retain) = self.queue.popitem(last=False)
+                self.client.publish(topic, payload, retain=retain)
+
+    async def run(self):
+        # Same as paho's loop_forever, including reconnection.  Connecting
+        # blocks until the broker answers or the TCP connection times out,
+        # so it runs on a thread
+        self.loop_thread = threading.get_ident()
+        backoff = 1
+        connections = 0
+        while not self.stopping:
+            try:
+                await self.loop.run_in_executor(None, self.client.reconnect)
+            except OSError as e:
+                print(f"could not connect to MQTT: {e}")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 60)
+                continue
+
+            if connections:
+                RECONNECTS.labels('mqtt').inc()
+            connections += 1
+            backoff = 1
+            while self.client.loop_misc() == paho.mqtt.client.MQTT_ERR_SUCCESS:
+                self.schedule_flush()
+                await asyncio.sleep(1)
+
+    async def disconnect(self, timeout=5):
+        self.stopping = True
+        self.flush(len(self.queue))
+        self.client.disconnect()
+        try:
+            await asyncio.wait_for(self.closed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+
+def timestamp_to_iso(ts):
+    return datetime.datetime.fromtimestamp(ts, datetime.timezone.utc).isoformat()
+
+
 class HA_MQTTGateway():
-    def __init__(self, host, token, mqtt_host, root_topic, username=None, password=None, loop=None):
+    def __init__(self, host, token, mqtt_host, root_topic, username=None, password=None, loop=None,
+                 entity_filter=None, subscribe_entities=False, attributes=None,
+                 max_inflight=4, rate=10, max_queue=10000, trace_interval=60):
         self.topic = root_topic
         self.loop = loop or asyncio.get_event_loop()
-
-        self.conn = HASSWebsockets(host, token, ["state_changed"])
+        self.entity_filter = entity_filter or EntityFilter()
+        self.attributes = attributes or AttributeSelector()
+
+        # With subscribe_entities, the states are kept in self.entities and
+        # updated from the compressed diffs sent by Home Assistant, instead
+        # of receiving full states from get_states and state_changed.
+        self.subscribe_entities = subscribe_entities
+        self.entities = dict()
+
+        # Hash of the state and last_changed last published for each
+        # entity, so that reconnects and changes to attributes or context
+        # only do not republish unchanged states.  Cleared when MQTT
+        # disconnects.
+        self.published = dict()
+        self.published_attributes = dict()
+
+        self.dispatcher = ServiceDispatcher(self.call_service, self.publish_result,
+                                            max_inflight, rate)
+        self.tracer = CommandTracer(self.publish_trace)
+        self.dispatcher.on_dispatch = self.tracer.on_dispatch
+        self.trace_interval = trace_interval
+
+        if subscribe_entities:
+            self.conn = HASSWebsockets(host, token, [])
+            self.conn.on_event = self.on_entities_event
+        else:
+            self.conn = HASSWebsockets(host, token, ["state_changed"])
+            self.conn.event_filter = self.entity_filter
+            self.conn.on_event = self.on_event
         self.conn.on_auth_ok = self.on_auth_ok
-        self.conn.on_event = self.on_event
+        self.conn.on_command = self.tracer.on_command
+        self.conn.on_result = self.tracer.on_result
+        PENDING_COMMANDS.set_function(lambda: len(self.conn.futures))
 
         self.mqtt_connected = False
         self.mqtt_host = mqtt_host
         self.mqtt = paho.mqtt.client.Client(self.topic)
-        self.mqtt.on_disconnect = lambda client, userdata, rc: \
-            self.loop.call_soon_threadsafe(self.on_disconnect)
-        self.mqtt.on_connect = lambda client, userdata, flags, rc: \
-            self.loop.call_soon_threadsafe(self.on_connect, rc)
-        self.mqtt.on_message = lambda client, userdata, message: \
-            self.loop.call_soon_threadsafe(self.on_message, message)
+        self.mqtt.on_disconnect = lambda client, userdata, rc: self.on_disconnect()
+        self.mqtt.on_connect = lambda client, userdata, flags, rc: self.on_connect(rc)
+        self.mqtt.on_message = lambda client, userdata, message: self.on_message(message)
+        self.transport = AsyncioMQTT(self.mqtt, self.loop, max_queue)
+        self.transport.on_drop = self.on_drop
         if username:
             self.mqtt.username_pw_set(username, password)
 
@@ -191,41 +682,180 @@ class HA_MQTTGateway():
             return
         if "entity_id" not in state:
             return
+        if not self.entity_filter(state["entity_id"]):
+            return
 
         entity_id = state["entity_id"]
+        self.publish_attributes(entity_id, state["attributes"])
         del state["attributes"]
         del state["context"]
         del state["entity_id"]
-        self.mqtt.publish(f"{self.topic}/{entity_id}/state",
+        self._publish_entity(entity_id, state)
+
+    def _publish_entity(self, entity_id, state):
+        # last_updated changes on every attribute-only update, so it is
+        # not part of the key
+        digest = hash((state["state"], state["last_changed"]))
+        if self.published.get(entity_id) == digest:
+            return
+        self.published[entity_id] = digest
+        self.transport.publish(f"{self.topic}/{entity_id}/state",
                           json.dumps(state), retain=True)
 
+    def publish_attributes(self, entity_id, attributes):
+        # Publish the selected attributes that changed since the last
+        # time, and clear those that went away
+        names = self.attributes(entity_id)
+        if not names:
+            return
+        published = self.published_attributes.setdefault(entity_id, dict())
+        for name in names:
+            payload = json.dumps(attributes[name]) if name in attributes else ""
+            if published.get(name, "") == payload:
+                continue
+            if payload:
+                published[name] = payload
+            else:
+                del published[name]
+            self.transport.publish(f"{self.topic}/{entity_id}/attributes/{name}",
+                              payload, retain=True)
+
+    def clear_entity(self, entity_id):
+        # clear the retained messages of a removed entity
+        self.published.pop(entity_id, None)
+        self.transport.publish(f"{self.topic}/{entity_id}/state", "", retain=True)
+        self.publish_attributes(entity_id, {})
+        self.published_attributes.pop(entity_id, None)
+
+    def publish_entity(self, entity_id):
+        if not self.mqtt_connected:
+            return
+        entity = self.entities.get(entity_id)
+        if entity is None:
+            self.clear_entity(entity_id)
+            return
+
+        self.publish_attributes(entity_id, entity["a"])
+
+        self._publish_entity(entity_id, {
+            "state": entity["s"],
+            "last_changed": timestamp_to_iso(entity["lc"]),
+            "last_updated": timestamp_to_iso(entity["lu"]),
+        })
+
     def on_auth_ok(self):
         async def do_get_states():
-            states = await self.conn.send_cmd({"type": "get_states"})
+            states = await self.conn.send_cmd({"type": "get_states"},
+                                              on_item=self.publish_state)
             for state in states["result"]:
                 self.publish_state(state)
 
         print("hass auth_ok")
         if self.mqtt_connected:
-            self.mqtt.publish(f"{self.topic}/connected", "1", retain=True)
-        self.loop.create_task(do_get_states())
+            self.transport.publish(f"{self.topic}/connected", "1", retain=True)
+        if self.subscribe_entities:
+            self.loop.create_task(self.conn.send_cmd({"type": "subscribe_entities"}))
+        else:
+            self.loop.create_task(do_get_states())
 
     def on_event(self, event):
-        self.publish_state(event["event"]["data"]["new_state"])
+        data = event["event"]["data"]
+        self.tracer.on_state(data["entity_id"])
+        if data["new_state"] is not None:
+            self.publish_state(data["new_state"])
+        elif self.mqtt_connected and self.entity_filter(data["entity_id"]):
+            self.clear_entity(data["entity_id"])
+        if "time_fired" in event["event"]:
+            fired = datetime.datetime.fromisoformat(event["event"]["time_fired"])
+            EVENT_LATENCY.observe(time.time() - fired.timestamp())
+
+    def on_entities_event(self, event):
+        # "a" adds entities (the first event has all of them), "c" has the
+        # changes to existing entities and "r" the entities that were removed.
+        # Last changed/updated times are timestamps, and last updated is
+        # omitted when it is the same as last changed.
+        event = event["event"]
+        for entity_id, state in event.get("a", {}).items():
+            if not self.entity_filter(entity_id):
+                continue
+            self.entities[entity_id] = {
+                "s": state["s"],
+                "a": state.get("a", {}),
+                "lc": state["lc"],
+                "lu": state.get("lu", state["lc"]),
+            }
+            self.publish_entity(entity_id)
+
+        for entity_id, diff in event.get("c", {}).items():
+            entity = self.entities.get(entity_id)
+            if entity is None:
+                continue
+            if "+" in diff:
+                added = diff["+"]
+                if "s" in added:
+                    entity["s"] = added["s"]
+                if "lc" in added:
+                    entity["lc"] = entity["lu"] = added["lc"]
+                elif "lu" in added:
+                    entity["lu"] = added["lu"]
+                entity["a"].update(added.get("a", {}))
+            if "-" in diff:
+                for name in diff["-"].get("a", []):
+                    entity["a"].pop(name, None)
+            self.tracer.on_state(entity_id)
+            self.publish_entity(entity_id)
+            EVENT_LATENCY.observe(time.time() - entity["lu"])
+
+        for entity_id in event.get("r", []):
+            if self.entities.pop(entity_id, None) is not None:
+                self.publish_entity(entity_id)
 
     async def call_service(self, domain, service, target, data={}):
-        try:
-            await self.conn.send_cmd({"type": "call_service",
-                                      "domain": domain,
-                                      "service": service,
-                                      "target": target,
-                                      "service_data": data})
-        except asyncio.CancelledError:
-            pass
+        return await self.conn.send_cmd({"type": "call_service",
+                                         "domain": domain,
+                                         "service": service,
+                                         "target": target,
+                                         "service_data": data})
+
+    def publish_result(self, key, result):
+        self.tracer.on_done(key)
+        if not self.mqtt_connected:
+            return
+        entity, domain, service = key
+        self.transport.publish(f"{self.topic}/{entity}/{domain}.{service}/result",
+                          json.dumps(result))
+
+    def publish_trace(self, key, trace):
+        if not self.mqtt_connected:
+            return
+        entity, domain, service = key
+        self.transport.publish(f"{self.topic}/{entity}/{domain}.{service}/trace",
+                          json.dumps(trace))
+
+    async def publish_trace_summary(self):
+        while True:
+            await asyncio.sleep(self.trace_interval)
+            self.tracer.expire()
+            if self.mqtt_connected and self.tracer.changed:
+                self.transport.publish(f"{self.topic}/diagnostics/commands",
+                                       json.dumps(self.tracer.summary()), retain=True)
+
+    def on_drop(self, topic):
+        # The broker still has the previous retained message, so forget
+        # what was published and send the next change even if it matches
+        parts = topic[len(self.topic)+1:].split('/')
+        if len(parts) == 2 and parts[1] == "state":
+            self.published.pop(parts[0], None)
+        elif len(parts) == 3 and parts[1] == "attributes":
+            published = self.published_attributes.get(parts[0])
+            if published is not None:
+                published[parts[2]] = None
 
     def on_disconnect(self):
         print("mqtt disconnected")
         self.mqtt_connected = False
+        self.published.clear()
+        self.published_attributes.clear()
 
     def on_connect(self, rc):
         if rc != 0:
@@ -236,6 +866,8 @@ class HA_MQTTGateway():
         self.mqtt.will_set(f"{self.topic}/connected", "0")
         self.mqtt_connected = True
         print("mqtt connected")
+        for entity_id in self.entities:
+            self.publish_entity(entity_id)
 
     def on_message(self, msg):
         topic = msg.topic[len(self.topic)+1:]
@@ -244,7 +876,8 @@ class HA_MQTTGateway():
 
         entity, service = topic.split('/', maxsplit=1)
 
-        if '.' not in service:
+        # ignore the gateway's own state and attributes topics
+        if '.' not in service or '/' in service:
             return
         domain, service = service.split('.', maxsplit=1)
 
@@ -258,16 +891,18 @@ class HA_MQTTGateway():
         else:
             data = {}
 
-        loop.create_task(self.call_service(domain, service,
-                                           {"entity_id": entity},
-                                           data))
+        self.tracer.on_message((entity, domain, service))
+        self.dispatcher.submit(entity, domain, service, data)
 
     async def main(self):
         print("mqtt starting")
-        self.mqtt.connect_async(self.mqtt_host)
-        self.mqtt.loop_start()
+        host, _, port = self.mqtt_host.partition(':')
+        self.mqtt.connect_async(host, int(port or 1883))
+        mqtt = self.loop.create_task(self.transport.run())
         print("mqtt started")
 
+        dispatcher = self.loop.create_task(self.dispatcher.run())
+        summary = self.loop.create_task(self.publish_trace_summary())
         try:
             await self.conn.run()
         except AuthInvalidError as e:
@@ -275,15 +910,36 @@ class HA_MQTTGateway():
         except asyncio.CancelledError:
             pass
         finally:
-            self.mqtt.publish(f"{self.topic}/connected", "0", retain=True)
-            self.mqtt.disconnect()
+            dispatcher.cancel()
+            summary.cancel()
+            self.transport.publish(f"{self.topic}/connected", "0", retain=True)
+            await self.transport.disconnect()
+            mqtt.cancel()
 
 
 ROOT = "ha-mqtt-gateway"
 
 parser = argparse.ArgumentParser()
-parser.add_argument('-H', '--mqtt-host', default='127.0.0.1', metavar='HOST', help='MQTT host')
+parser.add_argument('-H', '--mqtt-host', default='127.0.0.1', metavar='HOST[:PORT]', help='MQTT host')
 parser.add_argument('-f', '--token-file', metavar='TOKEN_FILE', help='file with Home Assistant API token')
+parser.add_argument('--include', metavar='RULE', action='append', default=[],
+                    help='only mirror entities matching a domain, glob or re:REGEX (can be repeated)')
+parser.add_argument('--exclude', metavar='RULE', action='append', default=[],
+                    help='do not mirror entities matching a domain, glob or re:REGEX (can be repeated)')
+parser.add_argument('--attributes', metavar='ENTITY_GLOB=NAME,...', action='append', default=[],
+                    help='publish the given attributes to ENTITY_ID/attributes/NAME (can be repeated)')
+parser.add_argument('--max-inflight', metavar='N', type=int, default=4,
+                    help='maximum number of service calls in flight')
+parser.add_argument('--rate', metavar='CALLS', type=float, default=10,
+                    help='maximum service calls per second (0 for no limit)')
+parser.add_argument('--trace-interval', metavar='SECONDS', type=float, default=60,
+                    help='how often to publish service call latency percentiles')
+parser.add_argument('--max-queue', metavar='N', type=int, default=10000,
+                    help='maximum number of topics waiting to be sent to the MQTT broker')
+parser.add_argument('--subscribe-entities', action='store_true',
+                    help='receive compressed state diffs instead of state_changed events')
+parser.add_argument('--metrics', metavar='[HOST:]PORT',
+                    help='serve Prometheus metrics over HTTP (default host: 127.0.0.1)')
 parser.add_argument('host', metavar='HOST', help='Home Assistant host')
 args = parser.parse_args()
 
@@ -292,7 +948,16 @@ with open(args.token_file, "r") as f:
 
 loop = asyncio.new_event_loop()
 asyncio.set_event_loop(loop)
+if args.metrics:
+    loop.run_until_complete(metrics.start_server(args.metrics))
 try:
-    loop.run_until_complete(HA_MQTTGateway(args.host, token, args.mqtt_host, ROOT, loop=loop).main())
+    loop.run_until_complete(HA_MQTTGateway(args.host, token, args.mqtt_host, ROOT, loop=loop,
+                                           entity_filter=EntityFilter(args.include, args.exclude),
+                                           subscribe_entities=args.subscribe_entities,
+                                           attributes=AttributeSelector(args.attributes),
+                                           max_inflight=args.max_inflight,
+                                           rate=args.rate,
+                                           max_queue=args.max_queue,
+                                           trace_interval=args.trace_interval).main())
 finally:
     loop.close()
@@ -0,0 +1,204 @@
+# Author: Paolo Bonzini
+# Licensed under AGPLv3.
+
+# Minimal instrumentation shared by ensolar2.py and ha-mqtt-gateway.py.
+#
+# Counters, gauges and histograms are created at module level and are
+# exported in the Prometheus text format by a small HTTP server that runs
+# on the daemon's asyncio event loop:
+#
+#   MODBUS_LATENCY = metrics.Histogram('ensolar2_modbus_request_seconds',
+#                                      'Modbus request latency', ['device'])
+#   MODBUS_LATENCY.labels('/dev/ttyUSB0').observe(0.25)
+#
+#   await metrics.start_server('9100')
+#
+# Metrics can be updated from any thread.
+
+import asyncio
+import bisect
+import threading
+import time
+
+REGISTRY = []
+
+LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = tuple(64 * 4 ** i for i in range(10))
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=()):
+    labels = [f'{k}="{_escape(v)}"' for k, v in zip(names, values)]
+    labels += [f'{k}="{v}"' for k, v in extra]
+    return '{' + ','.join(labels) + '}' if labels else ''
+
+
+def _format_value(value):
+    if value == int(value) and abs(value) < 1e16:
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.children = dict()
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def labels(self, *values):
+        values = tuple(str(v) for v in values)
+        try:
+            return self.children[values]
+        except KeyError:
+            with self.lock:
+                return self.children.setdefault(values, self._child())
+
+    def _child(self):
+        raise NotImplementedError
+
+    def collect(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} {self.type}'
+        for values, child in list(self.children.items()):
+            yield from child.collect(self.name, self.labelnames, values)
+
+    # unlabelled metrics can be used directly
+    def __getattr__(self, name):
+        if name in ('inc', 'dec', 'set', 'set_function', 'observe', 'time'):
+            return getattr(self.labels(), name)
+        raise AttributeError(name)
+
+
+class _Value:
+    def __init__(self):
+        self.value = 0
+        self.function = None
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, function):
+        # the value is computed when metrics are collected
+        self.function = function
+
+    def collect(self, name, labelnames, values):
+        value = self.function() if self.function else self.value
+        yield f'{name}{_format_labels(labelnames, values)} {_format_value(value)}'
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def _child(self):
+        return _Value()
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def _child(self):
+        return _Value()
+
+
+class _Timer:
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class _Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def time(self):
+        return _Timer(self)
+
+    def collect(self, name, labelnames, values):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else repr(float(bound))
+            yield f'{name}_bucket{_format_labels(labelnames, values, [("le", le)])} {cumulative}'
+        labels = _format_labels(labelnames, values)
+        yield f'{name}_sum{labels} {_format_value(total)}'
+        yield f'{name}_count{labels} {cumulative}'
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def _child(self):
+        return _Histogram(self.buckets)
+
+
+def exposition():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.collect())
+    return '\n'.join(lines) + '\n'
+
+
+async def _handle(reader, writer):
+    try:
+        request = await reader.readline()
+        while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+            pass
+        method, path, *_ = request.decode('latin-1').split() + ['', '']
+        if method == 'GET' and path.split('?')[0] in ('/', '/metrics'):
+            status, body = '200 OK', exposition().encode()
+        else:
+            status, body = '404 Not Found', b'not found\n'
+        writer.write(f'HTTP/1.0 {status}\r\n'
+                     'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                     f'Content-Length: {len(body)}\r\n'
+                     'Connection: close\r\n\r\n'.encode() + body)
+        await writer.drain()
+    except (ConnectionError, UnicodeDecodeError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_server(address):
+    # address is [HOST:]PORT; the default host is the loopback interface
+    host, _, port = address.rpartition(':')
+    return await asyncio.start_server(_handle, host or '127.0.0.1', int(port))
+
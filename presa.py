@@ -0,0 +1,214 @@
+#! /usr/bin/env python3
+
+# Author: Paolo Bonzini
+# Licensed under AGPLv3.
+
+# Turn loads on and off based on the solar roof production published by
+# ensolar2.py, through the switches exposed by ha-mqtt-gateway.py.
+#
+# Each load follows the same state machine as the old presa.sh:
+# - off: turned on when enough production is available (the threshold
+#   depends on the month) and home consumption is low, but only after it
+#   has been off for a while, to leave time to unplug after turning it off
+#   by hand
+# - on: turned off when production drops, but only after it has been on
+#   for at least an hour
+# - manual: turned on by hand; left alone until the night
+# - night: the inverter is not producing; the load is turned off the
+#   next morning
+#
+# Unlike presa.sh, the state is updated as soon as a new value arrives on
+# MQTT, and is only saved to disk when it changes.
+
+import argparse
+import json
+import math
+import os
+import paho.mqtt.client
+import threading
+import time
+
+MONTHLY_THRESHOLDS = {
+    1: 1250, 2: 1450, 3: 1600, 4: 1800, 5: 1900, 6: 1900,
+    7: 1900, 8: 1800, 9: 1600, 10: 1450, 11: 1250, 12: 1150,
+}
+
+LOAD_OPTIONS = {
+    'threshold-offset': 0,      # added to the monthly threshold
+    'off-threshold': 1150,      # turn off below this production (W)
+    'home-limit': 1400,         # do not turn on above this consumption (W)
+    'min-on': 60,               # minutes
+    'min-off': 10,              # minutes
+}
+
+
+class Load:
+    def __init__(self, topic, options=LOAD_OPTIONS):
+        self.topic = topic
+        self.entity = topic.rsplit('/', maxsplit=1)[-1]
+        self.domain = self.entity.split('.')[0]
+        self.options = options
+        self.state = None
+        self.switch = None
+        self.since = -math.inf
+
+    def set_switch(self, switch, now):
+        # At startup, the switch is considered to be in its state forever
+        if switch != self.switch:
+            if self.switch is not None:
+                self.since = now
+            self.switch = switch
+
+    def update(self, mode, available, home, now):
+        # Returns the service to call, if any
+        if mode in ['wait', 'discharging']:
+            self.state = 'night'
+            return None
+        if self.switch is None:
+            return None
+
+        # detect the switch being turned on or off by hand
+        if self.state is None:
+            self.state = self.switch
+        elif self.switch == 'on' and self.state == 'off':
+            self.state = 'manual'
+        elif self.switch == 'off' and self.state == 'on':
+            self.state = 'off'
+
+        minutes = (now - self.since) / 60
+        if self.state == 'off':
+            threshold = MONTHLY_THRESHOLDS[time.localtime().tm_mon] + self.options['threshold-offset']
+            if (minutes > self.options['min-off'] and available >= threshold and
+                    home < self.options['home-limit']):
+                self.state = 'on'
+                self.set_switch('on', now)
+                return 'turn_on'
+
+        elif self.state in ['night', 'on']:
+            if self.state == 'night' or (minutes > self.options['min-on'] and
+                                         available <= self.options['off-threshold']):
+                self.state = 'off'
+                self.set_switch('off', now)
+                return 'turn_off'
+
+        return None
+
+
+class Controller:
+    def __init__(self, client, loads, pv_topic='pv', state_file=None):
+        self.client = client
+        self.loads = { load.topic + '/state': load for load in loads }
+        self.pv_topic = pv_topic + '/'
+        self.state_file = state_file
+        self.mode = self.available = self.home = None
+        self.lock = threading.Lock()
+        self.load_state()
+
+        self.client.on_connect = lambda client, userdata, flags, rc: self.on_connect(rc)
+        self.client.on_message = lambda client, userdata, message: self.on_message(message)
+
+    def load_state(self):
+        if not self.state_file:
+            return
+        try:
+            with open(self.state_file) as f:
+                saved = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return
+        for load in self.loads.values():
+            if saved.get(load.topic) == 'manual':
+                load.state = 'manual'
+
+    def save_state(self):
+        if not self.state_file:
+            return
+        with open(self.state_file + '.tmp', 'w') as f:
+            json.dump({ load.topic: load.state for load in self.loads.values() }, f)
+        os.replace(self.state_file + '.tmp', self.state_file)
+
+    def on_connect(self, rc):
+        if rc != 0:
+            print("could not connect to MQTT")
+            return
+        topics = ['mode', 'production/available', 'home']
+        self.client.subscribe([(self.pv_topic + t, 0) for t in topics] +
+                              [(topic, 0) for topic in self.loads])
+
+    def on_message(self, msg):
+        try:
+            value = msg.payload.decode().strip()
+            with self.lock:
+                if msg.topic in self.loads:
+                    self.loads[msg.topic].set_switch(json.loads(value)['state'], time.monotonic())
+                elif msg.topic == self.pv_topic + 'mode':
+                    self.mode = value
+                elif msg.topic == self.pv_topic + 'production/available':
+                    self.available = float(value)
+                elif msg.topic == self.pv_topic + 'home':
+                    self.home = float(value)
+                self.update()
+        except (ValueError, KeyError, TypeError):
+            pass
+
+    def update(self):
+        if self.mode is None or self.available is None or self.home is None:
+            return
+
+        changed = False
+        for load in self.loads.values():
+            old_state = load.state
+            service = load.update(self.mode, self.available, self.home, time.monotonic())
+            if service:
+                self.client.publish(f'{load.topic}/{load.domain}.{service}', '')
+            if load.state != old_state:
+                print(f'{load.entity}: {old_state} -> {load.state} | {self.mode} '
+                      f'input {self.available} home {self.home}')
+                changed = True
+        if changed:
+            self.save_state()
+
+    def run(self, tick=60):
+        # Timers can expire without any new message arriving
+        self.client.loop_start()
+        while True:
+            time.sleep(tick)
+            with self.lock:
+                self.update()
+
+
+def parse_load(spec):
+    # TOPIC[,OPTION=VALUE...]
+    topic, *settings = spec.split(',')
+    options = dict(LOAD_OPTIONS)
+    for setting in settings:
+        key, _, value = setting.partition('=')
+        if key not in options:
+            raise argparse.ArgumentTypeError(f'unknown load option {key}')
+        options[key] = float(value)
+    return Load(topic, options)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Control loads based on solar production.')
+    parser.add_argument('-H', '--mqtt-host', default='127.0.0.1', metavar='HOST', help='MQTT host')
+    parser.add_argument('--pv-topic', metavar='TOPIC', default='pv', help='ensolar2.py base topic')
+    parser.add_argument('--state-file', metavar='FILE', default='presa.json',
+                        help='where to save the state of the loads')
+    parser.add_argument('loads', metavar='TOPIC[,OPTION=VALUE...]', type=parse_load, nargs='+',
+                        help='ha-mqtt-gateway.py topic of a switch; options are ' +
+                             ', '.join(LOAD_OPTIONS))
+    args = parser.parse_args()
+
+    client = paho.mqtt.client.Client()
+    controller = Controller(client, args.loads, args.pv_topic, args.state_file)
+    client.connect_async(args.mqtt_host)
+    try:
+        controller.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        client.disconnect()
+
+
+if __name__ == '__main__':
+    main()